@@ -23,4 +23,5 @@ setup(
     include_package_data=True,
     python_requires=">=3.8",
     install_requires=install_requires,
+    entry_points={"console_scripts": ["clandinin-to-nwb=clandinin_lab_to_nwb.cli:main"]},
 )
@@ -1 +1,15 @@
-from .brezovecnwbconverter import BrezovecNWBConverter
+def __getattr__(name):
+    # The converter pulls in neuroconv and pynwb so it is only imported when it is used
+    if name == "BrezovecNWBConverter":
+        from .brezovecnwbconverter import BrezovecNWBConverter
+
+        return BrezovecNWBConverter
+    if name == "BrezovecTiffNWBConverter":
+        from .brezovecnwbconverter import BrezovecTiffNWBConverter
+
+        return BrezovecTiffNWBConverter
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+__all__ = ["BrezovecNWBConverter", "BrezovecTiffNWBConverter"]
@@ -0,0 +1,154 @@
+"""Helpers to read the Bruker XML files without the heavy dependencies of the conversion."""
+
+from datetime import datetime
+from pathlib import Path
+from typing import List, Tuple, Union
+from xml.etree import ElementTree
+
+
+def get_channels_from_first_frame(xml_file):
+    """
+    Extract channel and channelName attributes from the File tags within the first Frame tag.
+
+    Parameters
+    ----------
+    xml_file : str or Path
+        Path to the XML file.
+
+    Returns
+    -------
+    list of tuple
+        A list containing tuples. Each tuple consists of (channel, channelName) attributes.
+    """
+
+    file_attributes_list = []
+    for event, elem in ElementTree.iterparse(xml_file, events=("start", "end")):
+        # We only need one frame so get out out of the loop when the first Frame tag is closed
+        if elem.tag == "Frame" and event == "end":
+            break
+
+        # For every file we extract the channel and channelName attributes and then clear the element
+        if elem.tag == "File" and event == "end":
+            file_attributes_list.append((elem.attrib.get("channel"), elem.attrib.get("channelName")))
+            elem.clear()
+
+    return file_attributes_list
+
+
+def count_frames_from_file(xml_file_path: Union[str, Path]) -> int:
+    """
+    Count the Frame elements of the XML file, there is one Frame element per plane of every volume.
+
+    Parameters
+    ----------
+    xml_file_path : str or Path
+        Path to the XML file.
+
+    Returns
+    -------
+    int
+        The number of Frame elements.
+    """
+    num_frames = 0
+    for event, elem in ElementTree.iterparse(xml_file_path, events=("end",)):
+        if elem.tag == "Frame":
+            num_frames += 1
+            elem.clear()
+
+    return num_frames
+
+
+def get_first_volume_files_from_file(xml_file_path: Union[str, Path], channel_name: str) -> List[Tuple[str, int]]:
+    """
+    Get the TIFF files of a channel in the Frame elements of the first Sequence, one per plane of the first volume.
+
+    Parameters
+    ----------
+    xml_file_path : str or Path
+        Path to the XML file.
+    channel_name : str
+        The channelName attribute of the File elements, for example "Green".
+
+    Returns
+    -------
+    list of tuple
+        The file name and the zero-based page index of each plane.
+    """
+    volume_files = []
+    for event, elem in ElementTree.iterparse(xml_file_path, events=("end",)):
+        # We only need one volume so get out of the loop when the first Sequence tag is closed
+        if elem.tag == "Sequence":
+            break
+
+        if elem.tag == "File" and elem.attrib.get("channelName") == channel_name:
+            volume_files.append((elem.attrib["filename"], int(elem.attrib.get("page", 1)) - 1))
+            elem.clear()
+
+    return volume_files
+
+
+def combine_date_and_sequence_time(date_string: str, sequence_time: str) -> datetime:
+    """
+    Combine the date of the PVScan element with the time of a Sequence element.
+
+    Parameters
+    ----------
+    date_string : str
+        The date attribute of the PVScan element, for example "6/20/2020 10:00:00 AM".
+    sequence_time : str
+        The time attribute of the Sequence element, for example "10:00:05.1234567-07:00".
+
+    Returns
+    -------
+    datetime
+        The start time of the sequence without time zone.
+    """
+    from dateutil import parser
+
+    date = datetime.strptime(date_string, "%m/%d/%Y %I:%M:%S %p")
+    sequence_timestamp = parser.parse(sequence_time)
+    combined_datetime = datetime(
+        date.year,
+        date.month,
+        date.day,
+        sequence_timestamp.hour,
+        sequence_timestamp.minute,
+        sequence_timestamp.second,
+        sequence_timestamp.microsecond,
+    )
+
+    return combined_datetime
+
+
+def read_session_start_time_from_file(xml_file_path: Union[str, Path]) -> datetime:
+    """
+    Read the start time of the series from the date of the PVScan element and the time of the first Sequence.
+
+    Parameters
+    ----------
+    xml_file_path : str or Path
+        Path to the XML file.
+
+    Returns
+    -------
+    datetime
+        The start time of the series without time zone.
+    """
+    date_string = None
+    sequence_time = None
+
+    for event, elem in ElementTree.iterparse(xml_file_path, events=("start", "end")):
+        # Extract the date from PVScan
+        if date_string is None and elem.tag == "PVScan" and event == "end":
+            date_string = elem.attrib.get("date")
+            elem.clear()
+
+        # Extract the time from Sequence
+        if sequence_time is None and elem.tag == "Sequence" and event == "end":
+            sequence_time = elem.get("time")
+            elem.clear()
+
+        if date_string is not None and sequence_time is not None:
+            break
+
+    return combine_date_and_sequence_time(date_string=date_string, sequence_time=sequence_time)
@@ -0,0 +1,323 @@
+"""Command line interface of the brezovec conversion.
+
+Only the standard library is imported at module level, the conversion stack is imported inside the commands that
+need it so that `--help`, `list` and `plan` start fast. `verify` exits with status 1 when the NWB file does not
+match the source data.
+"""
+
+import argparse
+from pathlib import Path
+
+
+def _select_sessions(args) -> list:
+    from clandinin_lab_to_nwb.brezovec.brezovec_convert_all_sessions import get_sessions
+
+    imports_dir_path = args.data_dir_path / "imports"
+    if not imports_dir_path.is_dir():
+        args.parser.error(f"{args.data_dir_path} is not a data directory, the folder {imports_dir_path} is missing.")
+
+    sessions = get_sessions(data_dir_path=args.data_dir_path)
+    if args.date_string is not None:
+        sessions = [session for session in sessions if session["date_string"] == args.date_string]
+    if args.subject_id is not None:
+        sessions = [session for session in sessions if session["subject_id"] == args.subject_id]
+
+    return sessions
+
+
+def _list_sessions(args):
+    for session in _select_sessions(args):
+        print(f"{session['date_string']} {session['subject_id']}")
+
+
+def _plan_sessions(args):
+    from clandinin_lab_to_nwb.brezovec.brezovec_convert_session import get_session_file_paths
+    from clandinin_lab_to_nwb.brezovec.brezovec_plan_session import load_calibration, pack_sessions, plan_session
+
+    calibration = load_calibration(args.calibration_file) if args.calibration_file is not None else None
+    output_dir_path = Path(args.output_dir_path)
+    if args.stub_test:
+        output_dir_path = output_dir_path / "nwb_stub"
+
+    session_plans = []
+    for session in _select_sessions(args):
+        session_plan = plan_session(
+            data_dir_path=args.data_dir_path,
+            num_prefetch_blocks=args.num_prefetch_blocks,
+            imaging_file_format=args.imaging_file_format,
+            node_memory_gb=args.node_memory_gb,
+            node_cpus=args.node_cpus,
+            calibration=calibration,
+            buffer_gb=args.buffer_gb,
+            **session,
+        )
+        session_plans.append(session_plan)
+
+        nwbfile_path = output_dir_path / session_plan["nwbfile_name"]
+        print("-" * 80)
+        print(f"Session {session['date_string']} {session['subject_id']} -> {nwbfile_path}")
+        if nwbfile_path.exists():
+            print("The NWB file already exists and would be overwritten")
+        if args.verbose:
+            session_file_paths = get_session_file_paths(data_dir_path=args.data_dir_path, **session)
+            for interface_name, imaging_source_data in session_file_paths["imaging_source_data"].items():
+                print(f"{interface_name}: {imaging_source_data['folder_path']}")
+            print(f"FicTrac: {session_file_paths['fictrac_file_path']}")
+            print(f"Video: {session_file_paths['video_file_path']}")
+            print(f"Processed: {session_file_paths['processed_file_path']}")
+        for series_plan in session_plan["series"]:
+            xml_num_frames = series_plan.get("xml_num_frames")
+            if xml_num_frames is not None and xml_num_frames != series_plan["shape"][0]:
+                print(
+                    f"{series_plan['name']}: {xml_num_frames} frames in the XML file but {series_plan['shape'][0]} in the NIfTI file"
+                )
+        print(
+            f"Uncompressed {session_plan['uncompressed_bytes'] / 1e9:.2f} GB, "
+            f"expected {session_plan['expected_bytes'] / 1e9:.2f} GB, "
+            f"peak memory {session_plan['peak_memory_bytes'] / 1e9:.2f} GB, "
+            f"runtime {session_plan['runtime_seconds'] / 60:.1f} minutes"
+        )
+        print(
+            f"Recommended buffer_gb={session_plan['recommended_buffer_gb']} "
+            f"and {session_plan['recommended_num_workers']} workers per node"
+        )
+        if args.buffer_gb is not None:
+            print(
+                f"With buffer_gb={args.buffer_gb}: "
+                f"peak memory {session_plan['buffer_peak_memory_bytes'] / 1e9:.2f} GB, "
+                f"runtime {session_plan['buffer_runtime_seconds'] / 60:.1f} minutes "
+                f"and {session_plan['buffer_num_workers']} workers per node"
+            )
+
+    print("-" * 80)
+    expected_gb = sum(plan["expected_bytes"] for plan in session_plans) / 1e9
+    runtime_hours = sum(plan["runtime_seconds"] for plan in session_plans) / 3600
+    print(f"{len(session_plans)} sessions, expected {expected_gb:.2f} GB and {runtime_hours:.2f} hours of conversion")
+
+    if args.num_nodes is not None:
+        for node_index, node_session_plans in enumerate(pack_sessions(session_plans, num_nodes=args.num_nodes)):
+            node_hours = sum(plan["runtime_seconds"] for plan in node_session_plans) / 3600
+            node_sessions = " ".join(f"{plan['date_string']}/{plan['subject_id']}" for plan in node_session_plans)
+            print(f"Node {node_index}: {node_hours:.2f} hours of conversion for {node_sessions}")
+
+
+def _convert_sessions(args):
+    if args.subject_id is not None and args.date_string is not None:
+        from clandinin_lab_to_nwb.brezovec.brezovec_convert_session import session_to_nwb
+
+        session_to_nwb(
+            data_dir_path=args.data_dir_path,
+            output_dir_path=args.output_dir_path,
+            subject_id=args.subject_id,
+            date_string=args.date_string,
+            stub_test=args.stub_test,
+            num_prefetch_blocks=args.num_prefetch_blocks,
+            imaging_file_format=args.imaging_file_format,
+            mask_file_path=args.mask_file_path,
+            num_mask_volumes=args.num_mask_volumes,
+            verbose=args.verbose,
+        )
+        return
+
+    if args.subject_id is not None or args.date_string is not None:
+        args.parser.error(
+            "Both --subject-id and --date-string are needed to convert a single session, "
+            "omit both to convert all the sessions."
+        )
+    from clandinin_lab_to_nwb.brezovec.brezovec_convert_all_sessions import convert_all_sessions
+
+    convert_all_sessions(
+        data_dir_path=args.data_dir_path,
+        output_dir_path=args.output_dir_path,
+        stub_test=args.stub_test,
+        queue_dir_path=args.queue_dir,
+        num_nodes=args.num_nodes,
+        node_index=args.node_index,
+        num_workers=args.num_workers or None,
+        imaging_file_format=args.imaging_file_format,
+        calibration_file_path=args.calibration_file,
+        mask_file_path=args.mask_file_path,
+        num_mask_volumes=args.num_mask_volumes,
+        verbose=args.verbose,
+    )
+
+
+def _calibrate(args):
+    from clandinin_lab_to_nwb.brezovec.brezovec_plan_session import (
+        calibrate_from_conversion,
+        calibrate_from_nwbfile,
+        load_calibration,
+        save_calibration,
+    )
+
+    # An existing calibration file is updated, for example with the throughputs of another conversion
+    calibration = load_calibration(args.calibration_file) if args.calibration_file.exists() else None
+    calibration = calibrate_from_nwbfile(nwbfile_path=args.nwbfile_path, calibration=calibration)
+    if args.conversion_seconds is not None:
+        calibration = calibrate_from_conversion(
+            nwbfile_path=args.nwbfile_path,
+            conversion_seconds=args.conversion_seconds,
+            num_prefetch_blocks=args.num_prefetch_blocks,
+            calibration=calibration,
+        )
+    save_calibration(calibration, calibration_file_path=args.calibration_file)
+    print(f"Wrote the calibration to {args.calibration_file}")
+
+
+def _verify_session(args):
+    from clandinin_lab_to_nwb.brezovec.brezovec_verify_session import verify_session
+
+    report = verify_session(
+        nwbfile_path=args.nwbfile_path,
+        data_dir_path=args.data_dir_path,
+        subject_id=args.subject_id,
+        date_string=args.date_string,
+        num_sample_frames=args.num_sample_frames,
+        num_sample_blocks=args.num_sample_blocks,
+        exhaustive=args.exhaustive,
+        stub_test=args.stub_test,
+        max_workers=args.max_workers,
+        seed=args.seed,
+        imaging_file_format=args.imaging_file_format,
+        verbose=True,
+    )
+    args.parser.exit(0 if report["passed"] else 1)
+
+
+def _follow_session(args):
+    from clandinin_lab_to_nwb.brezovec.brezovec_follow_session import follow_session_to_nwb
+
+    follow_session_to_nwb(
+        folder_path=args.folder_path,
+        nwbfile_path=args.nwbfile_path,
+        subject_id=args.subject_id,
+        imaging_purpose=args.imaging_purpose,
+        poll_interval=args.poll_interval,
+        idle_timeout=args.idle_timeout,
+        verbose=args.verbose,
+    )
+
+
+def add_brezovec_parser(subparsers):
+    """Add the `brezovec` command and its subcommands to the subparsers of the main parser."""
+    parser = subparsers.add_parser("brezovec", help="Conversion of the Brezovec et al. walking dataset.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    session_parser = argparse.ArgumentParser(add_help=False)
+    session_parser.add_argument(
+        "data_dir_path", type=Path, help="Directory with the imports, fictrac and processed data."
+    )
+    session_parser.add_argument("--date-string", default=None, help="Only the sessions of this date (YYYYMMDD).")
+    session_parser.add_argument("--subject-id", default=None, help="Only the sessions of this fly folder (e.g. fly2).")
+
+    output_parser = argparse.ArgumentParser(add_help=False)
+    output_parser.add_argument("output_dir_path", type=Path, help="Directory where the NWB files are written.")
+    output_parser.add_argument("--stub-test", action="store_true", help="Only write a few frames of imaging data.")
+    output_parser.add_argument(
+        "--imaging-file-format",
+        choices=["nifti", "tiff"],
+        default="nifti",
+        help="Read the raw imaging data from the NIfTI files or directly from the Bruker TIFF files.",
+    )
+
+    list_parser = commands.add_parser("list", parents=[session_parser], help="List the sessions in the data directory.")
+    list_parser.set_defaults(function=_list_sessions, parser=list_parser)
+
+    plan_parser = commands.add_parser(
+        "plan", parents=[session_parser, output_parser], help="Show the files that would be converted."
+    )
+    plan_parser.add_argument("--num-prefetch-blocks", type=int, default=1)
+    plan_parser.add_argument("--node-memory-gb", type=float, default=None, help="Defaults to this machine.")
+    plan_parser.add_argument("--node-cpus", type=int, default=None, help="Defaults to this machine.")
+    plan_parser.add_argument(
+        "--buffer-gb", type=float, default=None, help="Also estimate the conversion with this buffer size."
+    )
+    plan_parser.add_argument("--num-nodes", type=int, default=None, help="Show how the sessions are packed on nodes.")
+    plan_parser.add_argument(
+        "--calibration-file", type=Path, default=None, help="Calibration JSON written by `brezovec calibrate`."
+    )
+    plan_parser.add_argument("--verbose", action="store_true", help="Also show the source files of every session.")
+    plan_parser.set_defaults(function=_plan_sessions, parser=plan_parser)
+
+    convert_parser = commands.add_parser(
+        "convert", parents=[session_parser, output_parser], help="Convert one session or all the sessions."
+    )
+    convert_parser.add_argument(
+        "--queue-dir", type=Path, default=None, help="Work queue directory on a shared filesystem."
+    )
+    convert_parser.add_argument("--num-prefetch-blocks", type=int, default=1)
+    convert_parser.add_argument("--num-nodes", type=int, default=None, help="Pack the sessions onto this many nodes.")
+    convert_parser.add_argument("--node-index", type=int, default=None, help="The index of this node when packing.")
+    convert_parser.add_argument(
+        "--num-workers", type=int, default=1, help="Sessions converted at the same time, 0 uses the plan."
+    )
+    convert_parser.add_argument(
+        "--calibration-file",
+        type=Path,
+        default=None,
+        help="Calibration JSON written by `brezovec calibrate`, for the plans of the sessions.",
+    )
+    convert_parser.add_argument(
+        "--mask-file-path",
+        type=Path,
+        default=None,
+        help="NIfTI mask or atlas in the space of the processed data, its outside is not written.",
+    )
+    convert_parser.add_argument(
+        "--num-mask-volumes",
+        type=int,
+        default=10,
+        help="Volumes of the processed data the mask is computed from without --mask-file-path.",
+    )
+    convert_parser.add_argument("--verbose", action="store_true")
+    convert_parser.set_defaults(function=_convert_sessions, parser=convert_parser)
+
+    calibrate_parser = commands.add_parser(
+        "calibrate", help="Write the calibration of the plans from an already converted session."
+    )
+    calibrate_parser.add_argument("nwbfile_path", type=Path, help="A NWB file written without --stub-test.")
+    calibrate_parser.add_argument(
+        "calibration_file", type=Path, help="The calibration JSON to write, it is updated if it exists."
+    )
+    calibrate_parser.add_argument(
+        "--conversion-seconds", type=float, default=None, help="Also calibrate the throughputs with this runtime."
+    )
+    calibrate_parser.add_argument("--num-prefetch-blocks", type=int, default=1)
+    calibrate_parser.set_defaults(function=_calibrate, parser=calibrate_parser)
+
+    verify_parser = commands.add_parser("verify", help="Compare a converted NWB file with the source data.")
+    verify_parser.add_argument("nwbfile_path", type=Path)
+    verify_parser.add_argument(
+        "data_dir_path", type=Path, help="Directory with the imports, fictrac and processed data."
+    )
+    verify_parser.add_argument("subject_id", help="The fly folder of the session (e.g. fly2).")
+    verify_parser.add_argument("date_string", help="The date of the session (YYYYMMDD).")
+    verify_parser.add_argument("--num-sample-frames", type=int, default=5)
+    verify_parser.add_argument("--num-sample-blocks", type=int, default=50)
+    verify_parser.add_argument(
+        "--exhaustive", action="store_true", help="Compare checksums of every frame instead of sampling."
+    )
+    verify_parser.add_argument("--stub-test", action="store_true", help="The NWB file was written with --stub-test.")
+    verify_parser.add_argument("--max-workers", type=int, default=None)
+    verify_parser.add_argument("--seed", type=int, default=None)
+    verify_parser.add_argument(
+        "--imaging-file-format",
+        choices=["nifti", "tiff"],
+        default="nifti",
+        help="The files the raw imaging data was converted from.",
+    )
+    verify_parser.set_defaults(function=_verify_session, parser=verify_parser)
+
+    follow_parser = commands.add_parser("follow", help="Convert the imaging of a series while it is being acquired.")
+    follow_parser.add_argument("folder_path", type=Path, help="The folder of the series written by the microscope.")
+    follow_parser.add_argument("nwbfile_path", type=Path)
+    follow_parser.add_argument("subject_id", help="The subject of the NWB file (e.g. fly_094).")
+    follow_parser.add_argument("--imaging-purpose", choices=["Functional", "Anatomical"], default="Functional")
+    follow_parser.add_argument("--poll-interval", type=float, default=1.0, help="Seconds between reads of the XML.")
+    follow_parser.add_argument(
+        "--idle-timeout", type=float, default=600.0, help="Finalize after this many seconds without new data."
+    )
+    follow_parser.add_argument("--verbose", action="store_true")
+    follow_parser.set_defaults(function=_follow_session, parser=follow_parser)
+
+    return parser
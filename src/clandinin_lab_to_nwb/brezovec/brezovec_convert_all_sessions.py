@@ -1,45 +1,243 @@
 from pathlib import Path
-from clandinin_lab_to_nwb.brezovec.brezovec_convert_session import session_to_nwb
-
-from neuroconv.tools.path_expansion import LocalPathExpander
-
-# Define rooth path and data directory
-root_path = Path.home() / "Clandinin-CN-data-share"  # Change this to the directory where the data is stored
-data_dir_path = root_path / "brezovec_example_data"
-output_dir_path = root_path / "conversion_nwb"
-stub_test = False  # Set to False to convert the full session, otherwise only a stub will be converted for testing
-verbose = True
-
-# Specify source data (note this assumes the files are arranged in the same way as in the example data)
-base_directory = data_dir_path
-source_data_spec = {
-    "imaging": {
-        "base_directory": base_directory,
-        "folder_path": "imports/{date_string}/{subject_id}",
-    }
-}
-
-# Instantiate LocalPathExpander
-path_expander = LocalPathExpander()
-
-# Expand paths and extract metadata
-metadata_list = path_expander.expand_paths(source_data_spec)
-# Filter over directories
-metadata_list = [m for m in metadata_list if Path(m["source_data"]["imaging"]["folder_path"]).is_dir()]
-# Filter over flies to get only the directories that contain both functional and anatomical imaging
-metadata_list = [m for m in metadata_list if "fly" in Path(m["source_data"]["imaging"]["folder_path"]).name]
-for index, metadata in enumerate(metadata_list):
-    if verbose:
-        print("-" * 80)
-        print(f"Converting session {index + 1} of {len(metadata_list)}")
-
-    date_string = metadata["metadata"]["extras"]["date_string"]
-    subject_id = metadata["metadata"]["Subject"]["subject_id"]
-    session_to_nwb(
+from typing import List, Literal, Optional, Union
+import traceback
+
+from clandinin_lab_to_nwb.brezovec.brezovec_work_queue import SessionWorkQueue, run_worker
+
+
+def get_sessions(data_dir_path: Union[str, Path]) -> List[dict]:
+    """
+    Find the sessions in the data directory.
+
+    Note this assumes the files are arranged in the same way as in the example data.
+
+    Returns
+    -------
+    list of dict
+        Each session is a dictionary with the `date_string` and `subject_id` keys.
+    """
+    # The folders are arranged as imports/{date_string}/{subject_id}
+    imports_dir_path = Path(data_dir_path) / "imports"
+    sessions = []
+    for date_dir_path in sorted(path for path in imports_dir_path.iterdir() if path.is_dir()):
+        # Filter over flies to get only the directories that contain both functional and anatomical imaging
+        subject_dir_paths = sorted(path for path in date_dir_path.iterdir() if path.is_dir() and "fly" in path.name)
+        sessions.extend(dict(date_string=date_dir_path.name, subject_id=path.name) for path in subject_dir_paths)
+
+    return sessions
+
+
+def convert_all_sessions(
+    data_dir_path: Union[str, Path],
+    output_dir_path: Union[str, Path],
+    stub_test: bool = False,
+    queue_dir_path: Optional[Union[str, Path]] = None,
+    heartbeat_interval: float = 30.0,
+    heartbeat_timeout: float = 600.0,
+    num_nodes: Optional[int] = None,
+    node_index: Optional[int] = None,
+    num_workers: Optional[int] = 1,
+    imaging_file_format: Literal["nifti", "tiff"] = "nifti",
+    calibration_file_path: Optional[Union[str, Path]] = None,
+    mask_file_path: Optional[Union[str, Path]] = None,
+    num_mask_volumes: int = 10,
+    verbose: bool = False,
+):
+    """
+    Convert all the sessions in the data directory.
+
+    Parameters
+    ----------
+    data_dir_path : str or Path
+        The directory that contains the `imports`, `fictrac` and `processed_dataset` folders.
+    output_dir_path : str or Path
+        The directory where the NWB files are written.
+    stub_test : bool, default: False
+        If True, only a few frames of the imaging data are written.
+    queue_dir_path : str or Path, optional
+        A directory on a filesystem shared by all the workers. If given, the sessions are added to a work queue in
+        this directory and converted by this process together with any other process running this function with the
+        same `queue_dir_path`, on this or other nodes. Each session is converted once. Otherwise the sessions are
+        converted one after the other by this process.
+    heartbeat_interval : float, default: 30.0
+        The seconds between the heartbeats of a worker of the queue.
+    heartbeat_timeout : float, default: 600.0
+        The seconds without a heartbeat after which the session of a worker of the queue is converted by another one.
+    num_nodes : int, optional
+        If given, the sessions are packed onto this number of nodes according to their planned runtime and only the
+        sessions of the node `node_index` are converted. Cannot be used with `queue_dir_path`.
+    node_index : int, optional
+        The index of this node, from 0 to `num_nodes - 1`.
+    num_workers : int or None, default: 1
+        The number of sessions converted at the same time by this process. If None, the recommendation of the
+        conversion plans is used.
+    imaging_file_format : "nifti" or "tiff", default: "nifti"
+        Read the raw imaging data from the NIfTI files or directly from the Bruker TIFF files, see `session_to_nwb`.
+    calibration_file_path : str or Path, optional
+        A calibration written by `calibrate_from_nwbfile` or `calibrate_from_conversion` for the plans of the
+        sessions, defaults to `DEFAULT_CALIBRATION`.
+    mask_file_path : str or Path, optional
+        A NIfTI file with a mask or atlas in the space of the processed data of all the sessions, see `session_to_nwb`.
+    num_mask_volumes : int, default: 10
+        The number of volumes the mask of the processed data is computed from without `mask_file_path`.
+    verbose : bool, default: False
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    from clandinin_lab_to_nwb.brezovec.brezovec_convert_session import session_to_nwb
+    from clandinin_lab_to_nwb.brezovec.brezovec_plan_session import (
+        load_calibration,
+        pack_sessions,
+        plan_session,
+        plan_sessions,
+    )
+
+    assert queue_dir_path is None or num_nodes is None, "Use either a work queue or a fixed number of nodes."
+    assert num_nodes is None or node_index in range(num_nodes), "'node_index' must be between 0 and 'num_nodes - 1'."
+
+    sessions = get_sessions(data_dir_path=data_dir_path)
+    calibration = load_calibration(calibration_file_path) if calibration_file_path is not None else None
+    conversion_kwargs = dict(
+        data_dir_path=data_dir_path,
+        output_dir_path=output_dir_path,
+        stub_test=stub_test,
+        imaging_file_format=imaging_file_format,
+        mask_file_path=mask_file_path,
+        num_mask_volumes=num_mask_volumes,
+        verbose=verbose,
+    )
+
+    if queue_dir_path is not None:
+        work_queue = SessionWorkQueue(
+            queue_dir_path=queue_dir_path,
+            heartbeat_interval=heartbeat_interval,
+            heartbeat_timeout=heartbeat_timeout,
+        )
+        # Only the sessions that are added to the queue are planned, the workers that start later read the buffer size
+        # and the runtime of the plans from the queue instead of reading all the XML files again
+        queue_sessions = []
+        for session in work_queue.get_unregistered_sessions(sessions):
+            try:
+                plan = plan_session(
+                    data_dir_path=data_dir_path,
+                    imaging_file_format=imaging_file_format,
+                    calibration=calibration,
+                    **session,
+                )
+            except Exception:
+                # A session that can not be planned is added without a plan, its conversion fails in the worker that
+                # claims it and the session is marked as failed with the traceback instead of stopping every worker
+                if verbose:
+                    print(f"Could not plan session {work_queue.get_session_key(session)}:\n{traceback.format_exc()}")
+                queue_sessions.append(session)
+                continue
+
+            queue_sessions.append(
+                dict(
+                    session,
+                    buffer_gb=plan["recommended_buffer_gb"],
+                    runtime_seconds=plan["runtime_seconds"],
+                    recommended_num_workers=plan["recommended_num_workers"],
+                )
+            )
+        num_added_sessions = work_queue.add_sessions(queue_sessions)
+        if verbose:
+            print(f"Added {num_added_sessions} of {len(sessions)} sessions to the queue at {queue_dir_path}")
+        if num_workers is None:
+            num_workers = min(
+                (session.get("recommended_num_workers", 1) for session in work_queue.read_sessions()), default=1
+            )
+
+        # The workers write the output of each claim apart and move it to the output directory once it is done
+        worker_kwargs = dict(
+            queue_dir_path=queue_dir_path,
+            convert_session=session_to_nwb,
+            output_dir_path=output_dir_path,
+            heartbeat_interval=heartbeat_interval,
+            heartbeat_timeout=heartbeat_timeout,
+            conversion_kwargs=dict(
+                data_dir_path=data_dir_path,
+                stub_test=stub_test,
+                imaging_file_format=imaging_file_format,
+                mask_file_path=mask_file_path,
+                num_mask_volumes=num_mask_volumes,
+                verbose=verbose,
+            ),
+            verbose=verbose,
+        )
+        if num_workers == 1:
+            run_worker(**worker_kwargs)
+            return
+
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = [executor.submit(run_worker, **worker_kwargs) for _ in range(num_workers)]
+            for future in futures:
+                future.result()
+        return
+
+    if num_nodes is not None or num_workers is None:
+        # The plans give the buffer size that fits in memory and the runtime to start with the longest sessions
+        session_plans = plan_sessions(
+            data_dir_path=data_dir_path,
+            sessions=sessions,
+            imaging_file_format=imaging_file_format,
+            calibration=calibration,
+        )
+        if num_workers is None:
+            num_workers = min((plan["recommended_num_workers"] for plan in session_plans), default=1)
+        if num_nodes is not None:
+            session_plans = pack_sessions(session_plans, num_nodes=num_nodes, num_workers_per_node=num_workers)
+            session_plans = session_plans[node_index]
+
+        session_plans = sorted(session_plans, key=lambda plan: plan["runtime_seconds"], reverse=True)
+        sessions = [
+            dict(
+                date_string=plan["date_string"], subject_id=plan["subject_id"], buffer_gb=plan["recommended_buffer_gb"]
+            )
+            for plan in session_plans
+        ]
+        if verbose:
+            runtime_hours = sum(plan["runtime_seconds"] for plan in session_plans) / 3600
+            print(f"Planned {len(sessions)} sessions with an estimated runtime of {runtime_hours:.2f} hours")
+
+    if num_workers > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = [executor.submit(session_to_nwb, **session, **conversion_kwargs) for session in sessions]
+            for future in futures:
+                future.result()
+        return
+
+    for index, session in enumerate(sessions):
+        if verbose:
+            print("-" * 80)
+            print(f"Converting session {index + 1} of {len(sessions)}")
+
+        session_to_nwb(**session, **conversion_kwargs)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    # Define rooth path and data directory
+    root_path = Path.home() / "Clandinin-CN-data-share"  # Change this to the directory where the data is stored
+    data_dir_path = root_path / "brezovec_example_data"
+    output_dir_path = root_path / "conversion_nwb"
+    stub_test = False  # Set to False to convert the full session, otherwise only a stub will be converted for testing
+    verbose = True
+
+    # Run the same command on as many processes and nodes as wanted to share the sessions through a queue
+    parser = argparse.ArgumentParser(description="Convert all the sessions of the brezovec conversion.")
+    parser.add_argument("--queue-dir", type=Path, default=None, help="Work queue directory on a shared filesystem.")
+    parser.add_argument("--num-nodes", type=int, default=None, help="Pack the sessions onto this number of nodes.")
+    parser.add_argument("--node-index", type=int, default=None, help="The index of this node when packing.")
+    args = parser.parse_args()
+
+    convert_all_sessions(
         data_dir_path=data_dir_path,
         output_dir_path=output_dir_path,
-        subject_id=subject_id,
-        date_string=date_string,
         stub_test=stub_test,
+        queue_dir_path=args.queue_dir,
+        num_nodes=args.num_nodes,
+        node_index=args.node_index,
         verbose=verbose,
     )
@@ -1,37 +1,41 @@
 """Primary script to run to convert an entire session for of data using the NWBConverter."""
 
 from pathlib import Path
-from typing import Union
+from typing import Literal, Optional, Union
 import itertools
 from zoneinfo import ZoneInfo
 from datetime import datetime
+import json
 import time
 
-from neuroconv.utils import load_dict_from_file, dict_deep_update
+from clandinin_lab_to_nwb.brezovec.brezovec_bruker_xml import read_session_start_time_from_file
 
-from clandinin_lab_to_nwb.brezovec import BrezovecNWBConverter
-from clandinin_lab_to_nwb.brezovec.brezovecimaginginterface import BrezovecImagingInterface
 
+def get_session_file_paths(data_dir_path: Union[str, Path], subject_id: str, date_string: str) -> dict:
+    """
+    Locate the source files of a session in the data directory.
 
-def session_to_nwb(
-    data_dir_path: Union[str, Path],
-    output_dir_path: Union[str, Path],
-    subject_id: str,
-    date_string: str,
-    stub_test: bool = False,
-    verbose: bool = False,
-):
-    start_time = time.time()
+    Note this assumes that the files are arranged in the same way as in the example data.
+
+    Parameters
+    ----------
+    data_dir_path : str or Path
+        The directory that contains the `imports`, `fictrac` and `processed_dataset` folders.
+    subject_id : str
+        The name of the fly folder in the imports directory (e.g. "fly2").
+    date_string : str
+        The date of the session in the format YYYYMMDD.
+
+    Returns
+    -------
+    dict
+        A dictionary with the imaging source data per interface name, the paths of the FicTrac, video and
+        processed files, the session start time and the session and subject ids used in the NWB file.
+    """
     data_dir_path = Path(data_dir_path)
-    output_dir_path = Path(output_dir_path)
-    if stub_test:
-        output_dir_path = output_dir_path / "nwb_stub"
-    output_dir_path.mkdir(parents=True, exist_ok=True)
 
-    source_data = dict()
-    conversion_options = dict()
-    # Determine the correct directories and add Functional and Anatomical Imaging data
-    photon_series_index = 0
+    # Determine the correct directories for the Functional and Anatomical Imaging data
+    imaging_source_data = dict()
     imaging_purpose_mapping = dict(func_0="Functional", anat_0="Anatomical")
     for imaging_type, channel in itertools.product(["func_0", "anat_0"], ["Green", "Red"]):
         directory = data_dir_path / "imports" / date_string / subject_id / imaging_type
@@ -41,23 +45,18 @@ def session_to_nwb(
         imaging_purpose = imaging_purpose_mapping[imaging_type]
         interface_name = f"Imaging{imaging_purpose}{channel}"
 
-        source_data[interface_name] = {
+        imaging_source_data[interface_name] = {
             "folder_path": str(folder_path),
             "channel": channel,
             "imaging_purpose": imaging_purpose,
         }
-        conversion_options[interface_name] = {"stub_test": stub_test, "photon_series_index": photon_series_index}
-        if stub_test:
-            stub_frames = 5
-            conversion_options[interface_name]["stub_frames"] = stub_frames
-        photon_series_index += 1
 
     # Get the session start time from the Functional Green imaging data
-    folder_path = source_data["ImagingFunctionalGreen"]["folder_path"]
+    folder_path = imaging_source_data["ImagingFunctionalGreen"]["folder_path"]
     xml_file_path = Path(folder_path) / f"{Path(folder_path).name}.xml"
-    functional_imaging_datetime = BrezovecImagingInterface.read_session_start_time_from_file(xml_file_path)
+    functional_imaging_datetime = read_session_start_time_from_file(xml_file_path)
 
-    # Add Fictrac
+    # Fictrac
     fictrac_directory = data_dir_path / "fictrac"
     fictrac_files = (path for path in fictrac_directory.iterdir() if path.suffix == ".dat")
     pattern = f"fictrac-{date_string}"
@@ -71,34 +70,154 @@ def session_to_nwb(
     time_differences = [abs((x - functional_imaging_datetime).total_seconds()) for x in datetimes]
     closest_index = time_differences.index(min(time_differences))
     fictrac_file_path = fictrac_file_path_list[closest_index]
-    diameter_mm = 9.0  # From the Brezovec paper
-    diameter_meters = diameter_mm / 1000.0
-    source_data.update(dict(FicTrac=dict(file_path=str(fictrac_file_path), radius=diameter_meters / 2)))
 
     # Video
     video_file_path = fictrac_file_path.with_name(fictrac_file_path.stem + "-raw.avi")
-    file_paths = [video_file_path]
-    source_data.update(dict(Video=dict(file_paths=file_paths)))
-    conversion_options.update(dict(Video=dict(stub_test=stub_test)))
 
     # Use the datestring as a session id
     session_id = datetime_strings[closest_index]
     # Get the subject id from the json mapping provided by the authors
     json_file_path = Path(__file__).parent / "subject_mapping.json"
-    subject_mapping = load_dict_from_file(json_file_path)
+    with open(json_file_path, "r") as file:
+        subject_mapping = json.load(file)
     subject_id_without_underscores = subject_id.replace("_", "")
     fly = subject_mapping[date_string][subject_id_without_underscores]
-    subject_id = fly
+
+    # The processed data
+    folder_path = data_dir_path / "processed_dataset" / f"{fly}"
+    processed_file_path = folder_path / "brain_zscored_green_high_pass_masked_warped_to_FDA.nii"
+
+    session_file_paths = dict(
+        imaging_source_data=imaging_source_data,
+        session_start_datetime=functional_imaging_datetime,
+        fictrac_file_path=fictrac_file_path,
+        video_file_path=video_file_path,
+        processed_file_path=processed_file_path,
+        session_id=session_id,
+        subject_id=fly,
+    )
+
+    return session_file_paths
+
+
+def session_to_nwb(
+    data_dir_path: Union[str, Path],
+    output_dir_path: Union[str, Path],
+    subject_id: str,
+    date_string: str,
+    stub_test: bool = False,
+    num_prefetch_blocks: int = 1,
+    buffer_gb: Optional[float] = None,
+    imaging_file_format: Literal["nifti", "tiff"] = "nifti",
+    mask_file_path: Optional[Union[str, Path]] = None,
+    num_mask_volumes: int = 10,
+    verbose: bool = False,
+):
+    """
+    Convert a session to NWB.
+
+    Parameters
+    ----------
+    data_dir_path : str or Path
+        The directory that contains the `imports`, `fictrac` and `processed_dataset` folders.
+    output_dir_path : str or Path
+        The directory where the NWB file is written.
+    subject_id : str
+        The name of the fly folder in the imports directory (e.g. "fly2").
+    date_string : str
+        The date of the session in the format YYYYMMDD.
+    stub_test : bool, default: False
+        If True, only a few frames of the imaging data are written.
+    num_prefetch_blocks : int, default: 1
+        The number of buffers of imaging frames read ahead in the background while writing, 0 disables prefetching.
+        Every buffer read ahead takes `buffer_gb` of memory.
+    buffer_gb : float, optional
+        The size of the buffer of the imaging data chunk iterators, defaults to the one of neuroconv (1 GB).
+        See `plan_session` for a recommendation.
+    imaging_file_format : "nifti" or "tiff", default: "nifti"
+        Read the raw imaging data from the NIfTI files or directly from the Bruker TIFF files, the written data is
+        the same.
+    mask_file_path : str or Path, optional
+        A NIfTI file with a mask or atlas in the space of the processed data. The chunks of the processed data that
+        are outside of it are not written. Defaults to the mask of the first `num_mask_volumes` volumes.
+    num_mask_volumes : int, default: 10
+        The number of volumes of the processed data that the mask is computed from when there is no `mask_file_path`.
+    verbose : bool, default: False
+
+    Returns
+    -------
+    dict
+        The `nwbfile_path` of the written NWB file and the `conversion_seconds` that the conversion took, which can be
+        used to calibrate the conversion plans with `calibrate_from_conversion`, and the `prefetch_statistics` of
+        every imaging series by interface name. A series whose `read_wait_time` is larger than its `write_wait_time`
+        was I/O-bound, otherwise it was CPU-bound.
+    """
+    # The conversion stack is imported here so that listing and planning sessions start fast
+    from neuroconv.utils import load_dict_from_file, dict_deep_update
+
+    from clandinin_lab_to_nwb.brezovec import BrezovecNWBConverter, BrezovecTiffNWBConverter
+    from clandinin_lab_to_nwb.brezovec.brezovecimaginginterface import PrefetchingImagingInterface
+
+    start_time = time.time()
+    data_dir_path = Path(data_dir_path)
+    output_dir_path = Path(output_dir_path)
+    if stub_test:
+        output_dir_path = output_dir_path / "nwb_stub"
+    output_dir_path.mkdir(parents=True, exist_ok=True)
+
+    session_file_paths = get_session_file_paths(
+        data_dir_path=data_dir_path, subject_id=subject_id, date_string=date_string
+    )
+
+    source_data = dict()
+    conversion_options = dict()
+    # Add Functional and Anatomical Imaging data
+    for photon_series_index, (interface_name, imaging_source_data) in enumerate(
+        session_file_paths["imaging_source_data"].items()
+    ):
+        source_data[interface_name] = dict(imaging_source_data, verbose=verbose)
+        conversion_options[interface_name] = {
+            "stub_test": stub_test,
+            "photon_series_index": photon_series_index,
+            "num_prefetch_blocks": num_prefetch_blocks,
+        }
+        if buffer_gb is not None:
+            conversion_options[interface_name]["iterator_options"] = dict(buffer_gb=buffer_gb)
+        if stub_test:
+            stub_frames = 5
+            conversion_options[interface_name]["stub_frames"] = stub_frames
+
+    functional_imaging_datetime = session_file_paths["session_start_datetime"]
+
+    # Add Fictrac
+    fictrac_file_path = session_file_paths["fictrac_file_path"]
+    diameter_mm = 9.0  # From the Brezovec paper
+    diameter_meters = diameter_mm / 1000.0
+    source_data.update(dict(FicTrac=dict(file_path=str(fictrac_file_path), radius=diameter_meters / 2)))
+
+    # Video
+    video_file_path = session_file_paths["video_file_path"]
+    file_paths = [video_file_path]
+    source_data.update(dict(Video=dict(file_paths=file_paths)))
+    conversion_options.update(dict(Video=dict(stub_test=stub_test)))
+
+    session_id = session_file_paths["session_id"]
+    subject_id = session_file_paths["subject_id"]
 
     # Add the processed data
-    folder_path = data_dir_path / "processed_dataset" / f"{subject_id}"
-    file_path = folder_path / "brain_zscored_green_high_pass_masked_warped_to_FDA.nii"
-    source_data.update(dict(Processed=dict(file_path=str(file_path))))
+    file_path = session_file_paths["processed_file_path"]
+    source_data.update(dict(Processed=dict(file_path=str(file_path), verbose=verbose)))
     conversion_options["Processed"] = {
         "parent_container": "processing/ophys",
         "stub_test": stub_test,
         "photon_series_index": 4,
+        "num_prefetch_blocks": num_prefetch_blocks,
+        "num_mask_volumes": num_mask_volumes,
     }
+    if mask_file_path is not None:
+        conversion_options["Processed"]["mask_file_path"] = str(mask_file_path)
+    if buffer_gb is not None:
+        conversion_options["Processed"]["iterator_options"] = dict(buffer_gb=buffer_gb)
     if stub_test:
         stub_frames = 5
         conversion_options["Processed"]["stub_frames"] = stub_frames
@@ -107,7 +226,9 @@ def session_to_nwb(
         print("-" * 80)
         print(f"Converting session {session_id} for subject {subject_id}")
 
-    converter = BrezovecNWBConverter(source_data=source_data, verbose=verbose)
+    assert imaging_file_format in ("nifti", "tiff"), f"Unknown imaging file format '{imaging_file_format}'!"
+    converter_class = BrezovecTiffNWBConverter if imaging_file_format == "tiff" else BrezovecNWBConverter
+    converter = converter_class(source_data=source_data, verbose=verbose)
     metadata = converter.get_metadata()
 
     # Update default metadata with the editable in the corresponding yaml file
@@ -142,15 +263,22 @@ def session_to_nwb(
         conversion_options=conversion_options,
         overwrite=True,
     )
+    prefetch_statistics = {
+        interface_name: interface.get_prefetch_statistics()
+        for interface_name, interface in converter.data_interface_objects.items()
+        if isinstance(interface, PrefetchingImagingInterface)
+    }
 
     end_time = time.time()
+    conversion_time = end_time - start_time
     if verbose:
-        conversion_time = end_time - start_time
         conversion_time_minutes = conversion_time / 60.0
         file_path_size_GiB = Path(nwbfile_path).stat().st_size / 1e9
         print(f"Wrote {file_path_size_GiB} GiB to {nwbfile_path}")
         print(f"Conversion took {conversion_time_minutes:.2f} minutes or {conversion_time:.2f} seconds")
 
+    return dict(nwbfile_path=nwbfile_path, conversion_seconds=conversion_time, prefetch_statistics=prefetch_statistics)
+
 
 if __name__ == "__main__":
     from pathlib import Path
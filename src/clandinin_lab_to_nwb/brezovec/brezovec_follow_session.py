@@ -0,0 +1,434 @@
+"""Convert the imaging of a series to NWB while the microscope is still acquiring it."""
+
+from collections import deque
+from pathlib import Path
+from typing import List, Literal, Optional, Union
+from xml.etree import ElementTree
+import re
+import shutil
+import time
+
+import numpy as np
+
+from clandinin_lab_to_nwb.brezovec.brezovec_bruker_xml import combine_date_and_sequence_time
+
+
+class BrukerXMLFollower:
+    """
+    Parses the XML file of a Bruker series while the microscope is still writing it.
+
+    The state of the parser is kept between polls so every poll only reads the bytes appended since the last one.
+    The elements are removed from the tree once they are read so the memory does not grow with the acquisition.
+    """
+
+    def __init__(self, xml_file_path: Union[str, Path], read_size: int = 1024**2):
+        """
+        Parameters
+        ----------
+        xml_file_path : str or Path
+            The XML file of the series, it does not need to exist yet.
+        read_size : int, default: 1 MiB
+            The number of bytes read from the file at a time.
+        """
+        self.xml_file_path = Path(xml_file_path)
+        self.read_size = read_size
+        self.num_bytes_read = 0
+        self.is_complete = False
+        self.xml_metadata = None
+        self.is_volumetric = None
+        self.date_string = None
+        self.first_sequence_time = None
+
+        # XMLPullParser is the incremental form of iterparse, it is fed the new bytes instead of reading to the end
+        self._parser = ElementTree.XMLPullParser(events=("start", "end"))
+        self._root = None
+        self._sequence = None
+        self._volume = []
+
+    def poll(self) -> List[List[dict]]:
+        """
+        Read the bytes appended to the XML file since the last poll.
+
+        Returns
+        -------
+        list of list of dict
+            The volumes completed in the new bytes. Each volume is the list of its planes, and each plane is a dictionary
+            with the `relative_time` of the plane and the `files` of every channel as `(file_path, page_index)`.
+        """
+        volumes = []
+        if not self.xml_file_path.is_file():
+            return volumes
+
+        with open(self.xml_file_path, "rb") as xml_file:
+            xml_file.seek(self.num_bytes_read)
+            while new_bytes := xml_file.read(self.read_size):
+                self.num_bytes_read += len(new_bytes)
+                self._parser.feed(new_bytes)
+                volumes.extend(self._read_events())
+
+        return volumes
+
+    def _read_events(self) -> List[List[dict]]:
+        from clandinin_lab_to_nwb.brezovec.brezovecimagingextractor import (
+            _determine_imaging_is_volumetric,
+            _get_xml_metadata,
+        )
+
+        volumes = []
+        for event, element in self._parser.read_events():
+            if event == "start":
+                if element.tag == "PVScan":
+                    self._root = element
+                    self.date_string = element.attrib["date"]
+                elif element.tag == "Sequence":
+                    self._sequence = element
+                    if self.first_sequence_time is None:
+                        self.first_sequence_time = element.attrib["time"]
+                continue
+
+            # The state of the microscope in the root applies to the whole series, the one in the frames is skipped
+            if element.tag == "PVStateShard" and self.first_sequence_time is None:
+                self.xml_metadata = _get_xml_metadata(xml_root=self._root)
+                self.is_volumetric = _determine_imaging_is_volumetric(xml_root=self._root)
+            elif element.tag == "Frame":
+                plane = dict(relative_time=float(element.attrib["relativeTime"]), files=dict())
+                for file_element in element.findall("File"):
+                    file_path = self.xml_file_path.parent / file_element.attrib["filename"]
+                    page_index = int(file_element.attrib.get("page", 1)) - 1
+                    plane["files"][file_element.attrib["channelName"]] = (file_path, page_index)
+                self._sequence.remove(element)
+
+                # Every Sequence is a volume for volumetric imaging, otherwise every Frame is one
+                if self.is_volumetric:
+                    self._volume.append(plane)
+                else:
+                    volumes.append([plane])
+            elif element.tag == "Sequence":
+                if self.is_volumetric:
+                    volumes.append(self._volume)
+                    self._volume = []
+                self._root.remove(element)
+                self._sequence = None
+            elif element.tag == "PVScan":
+                self.is_complete = True
+
+        return volumes
+
+    def get_session_start_time(self):
+        return combine_date_and_sequence_time(date_string=self.date_string, sequence_time=self.first_sequence_time)
+
+
+def _read_volume(volume: List[dict], channel_name: str) -> Optional[np.ndarray]:
+    """
+    Read a volume in the NWB convention (width, height, depth), or None if its files are not completely written yet.
+    """
+    from tifffile import TiffFileError
+
+    from clandinin_lab_to_nwb.brezovec.brezovecimagingextractor import _index_tiff_pages, _read_tiff_page
+
+    planes = []
+    for plane in volume:
+        file_path, page_index = plane["files"][channel_name]
+        if not file_path.is_file():
+            return None
+        try:
+            ((offset, shape, dtype),) = _index_tiff_pages(file_path=file_path, page_indices=[page_index])
+            page = _read_tiff_page(file_path=file_path, page_index=page_index, offset=offset, shape=shape, dtype=dtype)
+        except (OSError, IndexError, ValueError, TiffFileError):
+            # The microscope is still writing the file
+            return None
+        # From the TIFF convention (rows, columns) to the NWB one (width, height)
+        planes.append(page.T)
+
+    return np.stack(planes, axis=-1)
+
+
+def _create_nwbfile(
+    nwbfile_path: Path,
+    follower: BrukerXMLFollower,
+    first_volumes: dict,
+    imaging_purpose: Literal["Functional", "Anatomical"],
+    sampling_frequency: Optional[float],
+    subject_id: str,
+    session_id: str,
+) -> dict:
+    """
+    Write an NWB file with an empty resizable TwoPhotonSeries for every channel and return the names of the series.
+    """
+    from zoneinfo import ZoneInfo
+
+    import h5py
+    from hdmf.backends.hdf5.h5_utils import H5DataIO
+    from neuroconv.tools.nwb_helpers import get_default_nwbfile_metadata, make_nwbfile_from_metadata
+    from neuroconv.tools.roiextractors import add_devices, add_imaging_plane
+    from neuroconv.tools.roiextractors.roiextractors import get_default_ophys_metadata
+    from neuroconv.utils import dict_deep_update, load_dict_from_file
+    from pynwb import NWBHDF5IO
+    from pynwb.ophys import TwoPhotonSeries
+
+    from clandinin_lab_to_nwb.brezovec.brezovecimaginginterface import BrezovecImagingInterface
+
+    metadata = get_default_nwbfile_metadata()
+    editable_metadata_path = Path(__file__).parent / "brezovec_metadata.yaml"
+    metadata = dict_deep_update(metadata, load_dict_from_file(editable_metadata_path))
+    timezone = ZoneInfo("America/Los_Angeles")  # Time zone for Stanford, California
+    metadata["NWBFile"]["session_start_time"] = follower.get_session_start_time().replace(tzinfo=timezone)
+    metadata["NWBFile"]["session_id"] = session_id
+    metadata["Subject"]["subject_id"] = subject_id
+    nwbfile = make_nwbfile_from_metadata(metadata=metadata)
+
+    series_names = dict()
+    for channel_name, first_volume in first_volumes.items():
+        width, height, depth = first_volume.shape
+        ophys_metadata = get_default_ophys_metadata()
+        ophys_metadata["Ophys"]["TwoPhotonSeries"] = [dict()]
+        ophys_metadata = BrezovecImagingInterface.update_imaging_metadata(
+            metadata=ophys_metadata,
+            xml_metadata=follower.xml_metadata,
+            channel=channel_name,
+            imaging_purpose=imaging_purpose,
+            sampling_frequency=sampling_frequency,
+            image_size=(height, width, depth),
+        )
+        add_devices(nwbfile=nwbfile, metadata=ophys_metadata)
+        imaging_plane_name = ophys_metadata["Ophys"]["ImagingPlane"][0]["name"]
+        add_imaging_plane(nwbfile=nwbfile, metadata=ophys_metadata, imaging_plane_name=imaging_plane_name)
+
+        # The number of volumes is not known so the series has timestamps instead of a rate
+        two_photon_series_metadata = dict(ophys_metadata["Ophys"]["TwoPhotonSeries"][0])
+        two_photon_series_metadata.pop("rate")
+        two_photon_series_metadata.pop("imaging_plane")
+        # One volume per chunk so every chunk is compressed once when its volume is appended
+        data = H5DataIO(
+            data=np.empty((0, width, height, depth), dtype=first_volume.dtype),
+            maxshape=(None, width, height, depth),
+            chunks=(1, width, height, depth),
+            compression=True,
+        )
+        timestamps = H5DataIO(data=np.empty((0,), dtype="float64"), maxshape=(None,), chunks=(1024,))
+        two_photon_series = TwoPhotonSeries(
+            **two_photon_series_metadata,
+            imaging_plane=nwbfile.imaging_planes[imaging_plane_name],
+            data=data,
+            timestamps=timestamps,
+        )
+        nwbfile.add_acquisition(two_photon_series)
+        series_names[channel_name] = two_photon_series.name
+
+    # Single-writer-multiple-readers needs the latest version of the file format
+    with h5py.File(nwbfile_path, "w", libver="latest") as file:
+        with NWBHDF5IO(file=file, mode="w") as io:
+            io.write(nwbfile)
+
+    return series_names
+
+
+def follow_session_to_nwb(
+    folder_path: Union[str, Path],
+    nwbfile_path: Union[str, Path],
+    subject_id: str,
+    imaging_purpose: Literal["Functional", "Anatomical"] = "Functional",
+    session_id: Optional[str] = None,
+    poll_interval: float = 1.0,
+    idle_timeout: float = 600.0,
+    verbose: bool = False,
+) -> dict:
+    """
+    Convert the imaging of a Bruker series to NWB while it is being acquired.
+
+    The XML file is parsed incrementally and the volumes are appended to the TwoPhotonSeries of every channel as soon
+    as their TIFF files are written. The NWB file is open in single-writer-multiple-readers (SWMR) mode so it can be
+    read during the acquisition with `h5py.File(nwbfile_path, "r", libver="latest", swmr=True)`. The file is
+    finalized when the XML file is closed by the microscope or when nothing is written for `idle_timeout` seconds.
+
+    Parameters
+    ----------
+    folder_path : str or Path
+        The folder of the series with the XML and TIFF files written by the microscope (e.g. func_0/TSeries-001).
+    nwbfile_path : str or Path
+        The NWB file to write, it is overwritten.
+    subject_id : str
+        The subject of the NWB file (e.g. "fly_094").
+    imaging_purpose : "Functional" or "Anatomical", default: "Functional"
+    session_id : str, optional
+        Defaults to the name of the folder.
+    poll_interval : float, default: 1.0
+        The seconds between two reads of the XML file.
+    idle_timeout : float, default: 600.0
+        The seconds without new data after which the acquisition is considered aborted and the file is finalized.
+    verbose : bool, default: False
+
+    Returns
+    -------
+    dict
+        The `nwbfile_path`, the `num_volumes` written and whether the acquisition `is_complete`.
+    """
+    import h5py
+
+    folder_path = Path(folder_path)
+    nwbfile_path = Path(nwbfile_path)
+    session_id = session_id or folder_path.name
+    follower = BrukerXMLFollower(xml_file_path=folder_path / f"{folder_path.name}.xml")
+
+    pending_volumes = deque()
+    nwbfile = None
+    num_volumes = 0
+    last_progress_time = time.time()
+    try:
+        while True:
+            num_bytes_read = follower.num_bytes_read
+            pending_volumes.extend(follower.poll())
+            if follower.num_bytes_read > num_bytes_read:
+                last_progress_time = time.time()
+
+            # Two volumes are needed to know the imaging rate of the metadata
+            if nwbfile is None and pending_volumes and (len(pending_volumes) >= 2 or follower.is_complete):
+                assert follower.is_volumetric, "The follow mode is for volumetric imaging."
+                channel_names = list(pending_volumes[0][0]["files"].keys())
+                first_volumes = {
+                    channel_name: _read_volume(pending_volumes[0], channel_name) for channel_name in channel_names
+                }
+                if all(volume is not None for volume in first_volumes.values()):
+                    sampling_frequency = None
+                    if len(pending_volumes) >= 2:
+                        volume_period = pending_volumes[1][0]["relative_time"] - pending_volumes[0][0]["relative_time"]
+                        sampling_frequency = 1.0 / volume_period
+                    series_names = _create_nwbfile(
+                        nwbfile_path=nwbfile_path,
+                        follower=follower,
+                        first_volumes=first_volumes,
+                        imaging_purpose=imaging_purpose,
+                        sampling_frequency=sampling_frequency,
+                        subject_id=subject_id,
+                        session_id=session_id,
+                    )
+                    nwbfile = h5py.File(nwbfile_path, "r+", libver="latest")
+                    nwbfile.swmr_mode = True
+                    if verbose:
+                        print(f"Writing {list(series_names.values())} to {nwbfile_path}")
+
+            # The volumes are appended in order so a volume that is not completely written blocks the next ones
+            while nwbfile is not None and pending_volumes:
+                volume = pending_volumes[0]
+                channel_volumes = {channel_name: _read_volume(volume, channel_name) for channel_name in series_names}
+                if any(channel_volume is None for channel_volume in channel_volumes.values()):
+                    break
+
+                for channel_name, channel_volume in channel_volumes.items():
+                    two_photon_series = nwbfile["acquisition"][series_names[channel_name]]
+                    for dataset_name, value in (("data", channel_volume), ("timestamps", volume[0]["relative_time"])):
+                        dataset = two_photon_series[dataset_name]
+                        dataset.resize(num_volumes + 1, axis=0)
+                        dataset[num_volumes] = value
+                        dataset.flush()
+                pending_volumes.popleft()
+                num_volumes += 1
+                last_progress_time = time.time()
+
+            if follower.is_complete and not pending_volumes:
+                break
+            if time.time() - last_progress_time > idle_timeout:
+                print(
+                    f"Nothing was written to {folder_path} for {idle_timeout} s, finalizing the NWB file "
+                    f"with {num_volumes} volumes and {len(pending_volumes)} incomplete volumes left out"
+                )
+                break
+            time.sleep(poll_interval)
+    finally:
+        if nwbfile is not None:
+            nwbfile.close()
+
+    if verbose:
+        print(f"Wrote {num_volumes} volumes to {nwbfile_path}, the acquisition is complete: {follower.is_complete}")
+
+    return dict(nwbfile_path=nwbfile_path, num_volumes=num_volumes, is_complete=follower.is_complete)
+
+
+def simulate_acquisition(
+    source_folder_path: Union[str, Path],
+    folder_path: Union[str, Path],
+    volume_interval: float = 0.5,
+    xml_write_size: int = 4096,
+    num_volumes: Optional[int] = None,
+):
+    """
+    Replay a series that was already acquired into another folder the way the microscope writes it.
+
+    For every volume the TIFF files are copied first and then its Sequence element is appended to the XML file in
+    pieces of `xml_write_size` characters, so a reader can find the XML file cut anywhere. The closing tag of the
+    PVScan element is written at the end.
+
+    Parameters
+    ----------
+    source_folder_path : str or Path
+        The folder of the series with the XML and TIFF files (e.g. func_0/TSeries-001).
+    folder_path : str or Path
+        The folder where the series is written, the XML file is named after it.
+    volume_interval : float, default: 0.5
+        The seconds between two volumes.
+    xml_write_size : int, default: 4096
+    num_volumes : int, optional
+        Stop after this many volumes without closing the XML file, like an acquisition that is aborted. By default
+        the whole series is replayed.
+    """
+    source_folder_path = Path(source_folder_path)
+    folder_path = Path(folder_path)
+    folder_path.mkdir(parents=True, exist_ok=True)
+    xml_text = (source_folder_path / f"{source_folder_path.name}.xml").read_text()
+
+    with open(folder_path / f"{folder_path.name}.xml", "w") as xml_file:
+        text_end = 0
+        for volume_index, sequence_match in enumerate(
+            re.finditer(r"<Sequence\b.*?</Sequence>", xml_text, flags=re.DOTALL)
+        ):
+            if volume_index == num_volumes:
+                return
+            for file_name in re.findall(r'filename="([^"]+)"', sequence_match.group()):
+                shutil.copy(source_folder_path / file_name, folder_path / file_name)
+
+            volume_text = xml_text[text_end : sequence_match.end()]
+            for piece_start in range(0, len(volume_text), xml_write_size):
+                xml_file.write(volume_text[piece_start : piece_start + xml_write_size])
+                xml_file.flush()
+            text_end = sequence_match.end()
+            time.sleep(volume_interval)
+
+        xml_file.write(xml_text[text_end:])
+
+
+if __name__ == "__main__":
+    import argparse
+    import threading
+
+    parser = argparse.ArgumentParser(description="Convert a series to NWB while it is being acquired.")
+    parser.add_argument("folder_path", type=Path, help="The folder of the series written by the microscope.")
+    parser.add_argument("nwbfile_path", type=Path)
+    parser.add_argument("subject_id", help="The subject of the NWB file (e.g. fly_094).")
+    parser.add_argument("--imaging-purpose", choices=["Functional", "Anatomical"], default="Functional")
+    parser.add_argument("--poll-interval", type=float, default=1.0)
+    parser.add_argument("--idle-timeout", type=float, default=600.0)
+    parser.add_argument(
+        "--simulate-from",
+        type=Path,
+        default=None,
+        help="Replay this series into folder_path as the microscope would, to try the follow mode locally.",
+    )
+    args = parser.parse_args()
+
+    if args.simulate_from is not None:
+        simulation_thread = threading.Thread(
+            target=simulate_acquisition,
+            kwargs=dict(source_folder_path=args.simulate_from, folder_path=args.folder_path),
+            daemon=True,
+        )
+        simulation_thread.start()
+
+    follow_session_to_nwb(
+        folder_path=args.folder_path,
+        nwbfile_path=args.nwbfile_path,
+        subject_id=args.subject_id,
+        imaging_purpose=args.imaging_purpose,
+        poll_interval=args.poll_interval,
+        idle_timeout=args.idle_timeout,
+        verbose=True,
+    )
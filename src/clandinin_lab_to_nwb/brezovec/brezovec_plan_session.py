@@ -0,0 +1,473 @@
+"""Estimate the output size, runtime and memory of the conversion of sessions before running it."""
+
+from pathlib import Path
+from typing import List, Literal, Optional, Tuple, Union
+import copy
+import json
+import math
+import os
+
+from clandinin_lab_to_nwb.brezovec.brezovec_bruker_xml import (
+    count_frames_from_file,
+    get_channels_from_first_frame,
+    get_first_volume_files_from_file,
+)
+from clandinin_lab_to_nwb.brezovec.brezovec_convert_session import get_session_file_paths
+
+# Rough starting values, see `calibrate_from_nwbfile` to update the compression ratios and `calibrate_from_conversion`
+# to update the throughputs with an already converted session, and `save_calibration` to reuse them
+DEFAULT_CALIBRATION = dict(
+    read_mb_per_second=200.0,  # Reading the NIfTI files from a network filesystem
+    compression_mb_per_second=60.0,  # gzip with the default level of neuroconv on one thread
+    compression_ratio=dict(
+        raw=0.7,  # uint16 photon counts
+        processed=0.5,  # float32 values that are zero outside of the brain mask
+        fictrac=0.4,  # Relative to the size of the FicTrac text file
+    ),
+    baseline_memory_gb=0.5,  # Python with the conversion stack imported
+)
+
+# Default size of the chunks of the neuroconv imaging data chunk iterator
+CHUNK_MB = 10.0
+
+
+def save_calibration(calibration: dict, calibration_file_path: Union[str, Path]):
+    """Write a calibration to a JSON file that can be read with `load_calibration`."""
+    Path(calibration_file_path).write_text(json.dumps(calibration, indent=4))
+
+
+def load_calibration(calibration_file_path: Union[str, Path]) -> dict:
+    """Read a calibration written by `save_calibration`, the missing numbers are the ones of `DEFAULT_CALIBRATION`."""
+    file_calibration = json.loads(Path(calibration_file_path).read_text())
+    calibration = dict(copy.deepcopy(DEFAULT_CALIBRATION), **file_calibration)
+    calibration["compression_ratio"] = dict(
+        DEFAULT_CALIBRATION["compression_ratio"], **file_calibration.get("compression_ratio", dict())
+    )
+    return calibration
+
+
+def _get_total_memory_gb() -> float:
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1e9
+
+
+def _get_buffer_bytes(num_frames: int, volume_shape: tuple, itemsize: int, buffer_gb: float) -> int:
+    # This mirrors how the buffer shape of `ImagingExtractorDataChunkIterator` is a multiple of the chunk shape
+    width, height, depth = volume_shape
+    frame_bytes = width * height * depth * itemsize
+    chunk_frames = max(1, min(num_frames, int(CHUNK_MB * 1e6 / (width * height * itemsize))))
+    buffer_frames = math.floor(buffer_gb * 1e9 / (chunk_frames * frame_bytes)) * chunk_frames
+    buffer_frames = min(max(buffer_frames, chunk_frames), num_frames)
+    return buffer_frames * frame_bytes
+
+
+def _get_buffer_memory_factor(num_prefetch_blocks: int) -> int:
+    return 2 + (num_prefetch_blocks + 1 if num_prefetch_blocks > 0 else 0)
+
+
+def _get_peak_memory_bytes(
+    series_plans: List[dict],
+    buffer_gb: float,
+    num_prefetch_blocks: int,
+    calibration: dict,
+) -> int:
+    # The series are written one after the other so the peak is the one of the largest series
+    peak_memory_bytes = 0
+    for series_plan in series_plans:
+        num_frames, width, height, depth = series_plan["shape"]
+        itemsize = series_plan["itemsize"]
+        buffer_bytes = _get_buffer_bytes(num_frames, (width, height, depth), itemsize, buffer_gb=buffer_gb)
+
+        # The buffer read from the extractor and the contiguous copy that is compressed, with prefetching also the
+        # buffers waiting in the queue and the one being read
+        series_memory_bytes = _get_buffer_memory_factor(num_prefetch_blocks) * buffer_bytes
+        peak_memory_bytes = max(peak_memory_bytes, series_memory_bytes)
+
+    return int(peak_memory_bytes + calibration["baseline_memory_gb"] * 1e9)
+
+
+def _get_first_buffers_bytes(series_plans: List[dict], buffer_gb: float) -> int:
+    first_buffers_bytes = 0
+    for series_plan in series_plans:
+        num_frames, width, height, depth = series_plan["shape"]
+        first_buffers_bytes += _get_buffer_bytes(num_frames, (width, height, depth), series_plan["itemsize"], buffer_gb)
+
+    return first_buffers_bytes
+
+
+def _get_runtime_seconds(
+    read_bytes: int,
+    imaging_bytes: int,
+    num_prefetch_blocks: int,
+    calibration: dict,
+    first_buffers_bytes: int = 0,
+) -> float:
+    # With prefetching reading overlaps with compression so the slowest of the two dominates, except for the first
+    # buffer of every series that is read before anything can be compressed
+    read_seconds = read_bytes / (calibration["read_mb_per_second"] * 1e6)
+    compression_seconds = imaging_bytes / (calibration["compression_mb_per_second"] * 1e6)
+    if num_prefetch_blocks > 0:
+        first_buffers_seconds = first_buffers_bytes / (calibration["read_mb_per_second"] * 1e6)
+        return max(read_seconds, compression_seconds) + first_buffers_seconds
+
+    return read_seconds + compression_seconds
+
+
+def _get_nifti_series_plan(name: str, file_path: Path, kind: str, calibration: dict) -> dict:
+    import nibabel as nib
+
+    # Only the header is read, the data is accessed lazily by nibabel
+    nibabel_image = nib.load(str(file_path))
+    width, height, depth, num_frames = nibabel_image.shape
+    itemsize = nibabel_image.header.get_data_dtype().itemsize
+    uncompressed_bytes = width * height * depth * num_frames * itemsize
+
+    series_plan = dict(
+        name=name,
+        file_path=str(file_path),
+        shape=(num_frames, width, height, depth),
+        itemsize=itemsize,
+        uncompressed_bytes=uncompressed_bytes,
+        expected_bytes=int(uncompressed_bytes * calibration["compression_ratio"][kind]),
+    )
+    return series_plan
+
+
+def _get_tiff_series_plan(
+    name: str, xml_file_path: Path, channel_name: str, num_frame_elements: int, kind: str, calibration: dict
+) -> dict:
+    from tifffile import TiffFile
+
+    # The number of planes comes from the first volume of the XML file and the image size from its first page
+    volume_files = get_first_volume_files_from_file(xml_file_path=xml_file_path, channel_name=channel_name)
+    depth = len(volume_files)
+    num_frames = num_frame_elements // depth
+    file_name, page_index = volume_files[0]
+    file_path = xml_file_path.parent / file_name
+    with TiffFile(file_path) as tiff_file:
+        first_page = tiff_file.pages[page_index]
+        height, width = first_page.shape
+        itemsize = first_page.dtype.itemsize
+    uncompressed_bytes = width * height * depth * num_frames * itemsize
+
+    series_plan = dict(
+        name=name,
+        file_path=str(file_path),
+        shape=(num_frames, width, height, depth),
+        itemsize=itemsize,
+        uncompressed_bytes=uncompressed_bytes,
+        expected_bytes=int(uncompressed_bytes * calibration["compression_ratio"][kind]),
+    )
+    return series_plan
+
+
+def plan_session(
+    data_dir_path: Union[str, Path],
+    subject_id: str,
+    date_string: str,
+    num_prefetch_blocks: int = 1,
+    imaging_file_format: Literal["nifti", "tiff"] = "nifti",
+    node_memory_gb: Optional[float] = None,
+    node_cpus: Optional[int] = None,
+    calibration: Optional[dict] = None,
+    buffer_gb: Optional[float] = None,
+) -> dict:
+    """
+    Estimate the output size, peak memory and runtime of the conversion of a session.
+
+    Only the NIfTI headers, the Frame elements of the XML files and the sizes of the FicTrac and video files are read.
+    The raw imaging series that are read from the TIFF files, or that have no NIfTI file, are sized from the XML file
+    and the first page of their TIFF files.
+
+    Parameters
+    ----------
+    data_dir_path : str or Path
+        The directory that contains the `imports`, `fictrac` and `processed_dataset` folders.
+    subject_id : str
+        The name of the fly folder in the imports directory (e.g. "fly2").
+    date_string : str
+        The date of the session in the format YYYYMMDD.
+    num_prefetch_blocks : int, default: 1
+        The prefetching setting of the conversion, see `session_to_nwb`.
+    imaging_file_format : "nifti" or "tiff", default: "nifti"
+        The files the raw imaging data is read from, see `session_to_nwb`.
+    node_memory_gb : float, optional
+        The memory of the nodes that run the conversion, defaults to the memory of this machine.
+    node_cpus : int, optional
+        The number of CPUs of the nodes that run the conversion, defaults to the CPUs of this machine.
+    calibration : dict, optional
+        Throughput, compression and memory numbers that replace the ones in `DEFAULT_CALIBRATION`, for example the
+        ones of `load_calibration`.
+    buffer_gb : float, optional
+        A buffer size to estimate the conversion with, in addition to the recommended one.
+
+    Returns
+    -------
+    dict
+        The plan of the session with the estimated `uncompressed_bytes`, `expected_bytes`, `peak_memory_bytes` and
+        `runtime_seconds`, the `recommended_buffer_gb` for the imaging data chunk iterators and the
+        `recommended_num_workers` per node. The estimates use the recommended buffer size. If `buffer_gb` is given,
+        the plan also has the `buffer_gb`, `buffer_peak_memory_bytes`, `buffer_runtime_seconds` and
+        `buffer_num_workers` estimated with that buffer size.
+    """
+    assert imaging_file_format in ("nifti", "tiff"), f"Unknown imaging file format '{imaging_file_format}'!"
+    calibration = dict(DEFAULT_CALIBRATION, **(calibration or dict()))
+    node_memory_gb = node_memory_gb or _get_total_memory_gb()
+    node_cpus = node_cpus or os.cpu_count()
+
+    session_file_paths = get_session_file_paths(
+        data_dir_path=data_dir_path, subject_id=subject_id, date_string=date_string
+    )
+
+    series_plans = []
+    num_frame_elements = dict()
+    for imaging_source_data in session_file_paths["imaging_source_data"].values():
+        folder_path = Path(imaging_source_data["folder_path"])
+        xml_file_path = folder_path / f"{folder_path.name}.xml"
+        channel_ids = {channel_name: channel for channel, channel_name in get_channels_from_first_frame(xml_file_path)}
+        channel_id = channel_ids[imaging_source_data["channel"]]
+        nifti_file_path = next(
+            (path for path in folder_path.glob("*.nii") if "channel_" + channel_id in path.name), None
+        )
+
+        # Both channels share the XML file so it is only read once
+        if xml_file_path not in num_frame_elements:
+            num_frame_elements[xml_file_path] = count_frames_from_file(xml_file_path)
+
+        name = f"TwoPhotonSeries{imaging_source_data['imaging_purpose']}{imaging_source_data['channel']}"
+        if imaging_file_format == "nifti" and nifti_file_path is not None:
+            series_plan = _get_nifti_series_plan(
+                name=name, file_path=nifti_file_path, kind="raw", calibration=calibration
+            )
+            num_planes = series_plan["shape"][3]
+            series_plan["xml_num_frames"] = num_frame_elements[xml_file_path] // num_planes
+        else:
+            series_plan = _get_tiff_series_plan(
+                name=name,
+                xml_file_path=xml_file_path,
+                channel_name=imaging_source_data["channel"],
+                num_frame_elements=num_frame_elements[xml_file_path],
+                kind="raw",
+                calibration=calibration,
+            )
+        series_plans.append(series_plan)
+
+    series_plans.append(
+        _get_nifti_series_plan(
+            name="TwoPhotonSeriesFunctionalGreenProcessed",
+            file_path=session_file_paths["processed_file_path"],
+            kind="processed",
+            calibration=calibration,
+        )
+    )
+
+    fictrac_bytes = session_file_paths["fictrac_file_path"].stat().st_size
+    # The video is linked as an external file so it does not add to the size of the NWB file
+    video_bytes = session_file_paths["video_file_path"].stat().st_size
+
+    imaging_bytes = sum(series_plan["uncompressed_bytes"] for series_plan in series_plans)
+    uncompressed_bytes = imaging_bytes + fictrac_bytes
+    expected_bytes = sum(series_plan["expected_bytes"] for series_plan in series_plans)
+    expected_bytes += int(fictrac_bytes * calibration["compression_ratio"]["fictrac"])
+
+    # Each conversion keeps about two CPUs busy, one reading and one compressing, and the buffer is chosen so that
+    # that many conversions fit in the memory of the node
+    max_num_workers = max(1, node_cpus // 2)
+    memory_per_worker_bytes = node_memory_gb * 1e9 / max_num_workers
+    memory_kwargs = dict(
+        series_plans=series_plans,
+        num_prefetch_blocks=num_prefetch_blocks,
+        calibration=calibration,
+    )
+    fixed_memory_bytes = _get_peak_memory_bytes(buffer_gb=0.0, **memory_kwargs)
+    buffer_memory_factor = _get_buffer_memory_factor(num_prefetch_blocks)
+    recommended_buffer_gb = (memory_per_worker_bytes - fixed_memory_bytes) / buffer_memory_factor / 1e9
+    recommended_buffer_gb = round(min(max(recommended_buffer_gb, 0.05), 1.0), 2)
+
+    runtime_kwargs = dict(
+        read_bytes=uncompressed_bytes,
+        imaging_bytes=imaging_bytes,
+        num_prefetch_blocks=num_prefetch_blocks,
+        calibration=calibration,
+    )
+
+    def get_buffer_estimates(buffer_gb: float) -> Tuple[int, float, int]:
+        peak_memory_bytes = _get_peak_memory_bytes(buffer_gb=buffer_gb, **memory_kwargs)
+        runtime_seconds = _get_runtime_seconds(
+            first_buffers_bytes=_get_first_buffers_bytes(series_plans, buffer_gb=buffer_gb), **runtime_kwargs
+        )
+        num_workers = max(1, min(max_num_workers, math.floor(node_memory_gb * 1e9 / peak_memory_bytes)))
+        return peak_memory_bytes, runtime_seconds, num_workers
+
+    peak_memory_bytes, runtime_seconds, recommended_num_workers = get_buffer_estimates(recommended_buffer_gb)
+
+    session_plan = dict(
+        date_string=date_string,
+        subject_id=subject_id,
+        nwbfile_name=f"{session_file_paths['subject_id']}.nwb",
+        series=series_plans,
+        fictrac_bytes=fictrac_bytes,
+        video_bytes=video_bytes,
+        uncompressed_bytes=uncompressed_bytes,
+        expected_bytes=expected_bytes,
+        peak_memory_bytes=peak_memory_bytes,
+        runtime_seconds=runtime_seconds,
+        recommended_buffer_gb=recommended_buffer_gb,
+        recommended_num_workers=recommended_num_workers,
+    )
+    if buffer_gb is not None:
+        buffer_peak_memory_bytes, buffer_runtime_seconds, buffer_num_workers = get_buffer_estimates(buffer_gb)
+        session_plan.update(
+            buffer_gb=buffer_gb,
+            buffer_peak_memory_bytes=buffer_peak_memory_bytes,
+            buffer_runtime_seconds=buffer_runtime_seconds,
+            buffer_num_workers=buffer_num_workers,
+        )
+    return session_plan
+
+
+def plan_sessions(data_dir_path: Union[str, Path], sessions: List[dict], **plan_kwargs) -> List[dict]:
+    """Plan the conversion of several sessions, see `plan_session` for the keyword arguments."""
+    return [plan_session(data_dir_path=data_dir_path, **session, **plan_kwargs) for session in sessions]
+
+
+def pack_sessions(session_plans: List[dict], num_nodes: int, num_workers_per_node: Optional[int] = None) -> List[list]:
+    """
+    Assign the planned sessions to nodes so that all the nodes finish at about the same time.
+
+    The sessions are assigned from the longest to the shortest to the worker with the least work, see the
+    longest-processing-time-first rule.
+
+    Parameters
+    ----------
+    session_plans : list of dict
+        The output of `plan_sessions`.
+    num_nodes : int
+        The number of nodes.
+    num_workers_per_node : int, optional
+        The number of conversions run at the same time on every node, defaults to the smallest recommendation of the
+        plans so that every session fits in memory.
+
+    Returns
+    -------
+    list of list of dict
+        The session plans assigned to each node.
+    """
+    if num_workers_per_node is None:
+        num_workers_per_node = min((plan["recommended_num_workers"] for plan in session_plans), default=1)
+
+    worker_loads = [0.0] * (num_nodes * num_workers_per_node)
+    node_session_plans = [[] for _ in range(num_nodes)]
+    for session_plan in sorted(session_plans, key=lambda plan: plan["runtime_seconds"], reverse=True):
+        worker_index = worker_loads.index(min(worker_loads))
+        worker_loads[worker_index] += session_plan["runtime_seconds"]
+        node_session_plans[worker_index // num_workers_per_node].append(session_plan)
+
+    return node_session_plans
+
+
+def _get_photon_series_sizes(nwbfile_path: Union[str, Path]) -> dict:
+    """The stored and uncompressed bytes of the data of the photon series in the acquisition and processing groups."""
+    import h5py
+
+    photon_series_sizes = dict()
+    with h5py.File(nwbfile_path, "r") as file:
+        for group_name in ("acquisition", "processing"):
+            stored_bytes = 0
+            uncompressed_bytes = 0
+
+            def add_photon_series_sizes(name, h5_object):
+                nonlocal stored_bytes, uncompressed_bytes
+                if isinstance(h5_object, h5py.Dataset) and name.endswith("data") and h5_object.ndim == 4:
+                    stored_bytes += h5_object.id.get_storage_size()
+                    uncompressed_bytes += h5_object.size * h5_object.dtype.itemsize
+
+            if group_name in file:
+                file[group_name].visititems(add_photon_series_sizes)
+            photon_series_sizes[group_name] = (stored_bytes, uncompressed_bytes)
+
+    return photon_series_sizes
+
+
+def calibrate_from_nwbfile(
+    nwbfile_path: Union[str, Path],
+    calibration: Optional[dict] = None,
+    calibration_file_path: Optional[Union[str, Path]] = None,
+) -> dict:
+    """
+    Update the compression ratios of a calibration with the ones of an already converted session.
+
+    Parameters
+    ----------
+    nwbfile_path : str or Path
+        A NWB file written by `session_to_nwb`.
+    calibration : dict, optional
+        The calibration to update, defaults to `DEFAULT_CALIBRATION`.
+    calibration_file_path : str or Path, optional
+        If given, the updated calibration is also written to this JSON file, see `save_calibration`.
+
+    Returns
+    -------
+    dict
+        The updated calibration.
+    """
+    calibration = copy.deepcopy(calibration or DEFAULT_CALIBRATION)
+    group_kinds = dict(acquisition="raw", processing="processed")
+    for group_name, (stored_bytes, uncompressed_bytes) in _get_photon_series_sizes(nwbfile_path).items():
+        if uncompressed_bytes > 0:
+            calibration["compression_ratio"][group_kinds[group_name]] = stored_bytes / uncompressed_bytes
+
+    if calibration_file_path is not None:
+        save_calibration(calibration, calibration_file_path=calibration_file_path)
+    return calibration
+
+
+def calibrate_from_conversion(
+    nwbfile_path: Union[str, Path],
+    conversion_seconds: float,
+    num_prefetch_blocks: int = 1,
+    calibration: Optional[dict] = None,
+    calibration_file_path: Optional[Union[str, Path]] = None,
+) -> dict:
+    """
+    Update the throughputs of a calibration with the time that the conversion of a session took.
+
+    A single time can not tell reading from compressing apart, so both throughputs are scaled by the same factor so
+    that the runtime estimated for the imaging data of the session is the measured one. The time of the rest of the
+    conversion is attributed to the imaging data, so sessions are estimated to take a bit longer rather than shorter.
+
+    Parameters
+    ----------
+    nwbfile_path : str or Path
+        A NWB file written by `session_to_nwb` without `stub_test`.
+    conversion_seconds : float
+        The time that the conversion took, returned by `session_to_nwb`.
+    num_prefetch_blocks : int, default: 1
+        The prefetching setting of the conversion.
+    calibration : dict, optional
+        The calibration to update, defaults to `DEFAULT_CALIBRATION`.
+    calibration_file_path : str or Path, optional
+        If given, the updated calibration is also written to this JSON file, see `save_calibration`.
+
+    Returns
+    -------
+    dict
+        The updated calibration.
+    """
+    calibration = copy.deepcopy(calibration or DEFAULT_CALIBRATION)
+    imaging_bytes = sum(uncompressed_bytes for _, uncompressed_bytes in _get_photon_series_sizes(nwbfile_path).values())
+    assert imaging_bytes > 0, f"The NWB file '{nwbfile_path}' has no imaging data to calibrate with!"
+    assert conversion_seconds > 0, "'conversion_seconds' must be positive!"
+
+    estimated_seconds = _get_runtime_seconds(
+        read_bytes=imaging_bytes,
+        imaging_bytes=imaging_bytes,
+        num_prefetch_blocks=num_prefetch_blocks,
+        calibration=calibration,
+    )
+    throughput_scale = estimated_seconds / conversion_seconds
+    calibration["read_mb_per_second"] *= throughput_scale
+    calibration["compression_mb_per_second"] *= throughput_scale
+
+    if calibration_file_path is not None:
+        save_calibration(calibration, calibration_file_path=calibration_file_path)
+    return calibration
@@ -0,0 +1,330 @@
+"""Verify a converted NWB file against the source data of the session without reading everything twice."""
+
+from pathlib import Path
+from typing import Literal, Optional, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+
+import numpy as np
+
+from clandinin_lab_to_nwb.brezovec.brezovec_bruker_xml import read_session_start_time_from_file
+from clandinin_lab_to_nwb.brezovec.brezovec_convert_session import get_session_file_paths
+from clandinin_lab_to_nwb.brezovec.brezovecimagingextractor import (
+    BrezovecMultiPlaneImagingExtractor,
+    BrezovecMultiPlaneTiffImagingExtractor,
+    NIfTIImagingExtractor,
+)
+from roiextractors.imagingextractor import ImagingExtractor
+
+
+def _get_series_timestamps(photon_series) -> np.ndarray:
+    if photon_series.timestamps is not None:
+        return np.asarray(photon_series.timestamps[:])
+
+    num_frames = photon_series.data.shape[0]
+    return photon_series.starting_time + np.arange(num_frames) / photon_series.rate
+
+
+def _sample_block(rng: np.random.Generator, volume_shape: Tuple[int, ...], block_shape: Tuple[int, ...]):
+    block = []
+    for size, length in zip(volume_shape, block_shape):
+        length = min(length, size)
+        start = int(rng.integers(size - length + 1))
+        block.append(slice(start, start + length))
+
+    return tuple(block)
+
+
+def _check_frame(photon_series, extractor: ImagingExtractor, frame: int) -> Optional[str]:
+    # The NWB data is written as (t, x - columns, y - rows, z) so we transpose the (t, y, x, z) output of get_video
+    source_volume = extractor.get_video(start_frame=frame, end_frame=frame + 1)[0].transpose(1, 0, 2)
+    nwb_volume = photon_series.data[frame]
+    if not np.array_equal(source_volume, nwb_volume):
+        return f"{photon_series.name}: frame {frame} differs from the source"
+
+    return None
+
+
+def _check_block(photon_series, extractor: ImagingExtractor, frame: int, block: Tuple[slice, ...]) -> Optional[str]:
+    if isinstance(extractor, NIfTIImagingExtractor):
+        # The nibabel array proxy behind get_video is in (x, y, z, t) order which matches the NWB layout without the
+        # time axis, this way only the voxels of the block are read from the NIfTI file
+        source_block = extractor.nibabel_image.dataobj[block + (frame,)]
+    else:
+        # The TIFF pages hold whole planes so the frame is read and transposed as in `_check_frame`
+        source_block = extractor.get_video(start_frame=frame, end_frame=frame + 1)[0].transpose(1, 0, 2)[block]
+    nwb_block = photon_series.data[(frame,) + block]
+    if not np.array_equal(source_block, nwb_block):
+        block_string = ", ".join(f"{axis.start}:{axis.stop}" for axis in block)
+        return f"{photon_series.name}: block [{block_string}] of frame {frame} differs from the source"
+
+    return None
+
+
+def _hash_frames(read_frames, start_frame: int, end_frame: int, frames_per_slab: int, dtype: np.dtype) -> str:
+    # The frames are read and hashed a slab at a time so that only one slab is in memory
+    checksum = hashlib.sha256()
+    for slab_start_frame in range(start_frame, end_frame, frames_per_slab):
+        slab = read_frames(slab_start_frame, min(slab_start_frame + frames_per_slab, end_frame))
+        slab = np.ascontiguousarray(slab, dtype=dtype)
+        if np.issubdtype(dtype, np.floating):
+            # Chunks that were not written read as the fill value 0.0 while the source can have -0.0 outside the mask
+            slab = slab + 0.0
+        checksum.update(memoryview(slab))
+
+    return checksum.hexdigest()
+
+
+def _check_block_checksum(
+    photon_series, extractor: ImagingExtractor, start_frame: int, end_frame: int, frames_per_slab: int
+) -> Optional[str]:
+    dtype = photon_series.data.dtype
+    frame_range_kwargs = dict(
+        start_frame=start_frame, end_frame=end_frame, frames_per_slab=frames_per_slab, dtype=dtype
+    )
+    nwb_checksum = _hash_frames(lambda start, end: photon_series.data[start:end], **frame_range_kwargs)
+    # The NWB data is written as (t, x - columns, y - rows, z) so we transpose the (t, y, x, z) output of get_video
+    source_checksum = _hash_frames(
+        lambda start, end: extractor.get_video(start_frame=start, end_frame=end).transpose(0, 2, 1, 3),
+        **frame_range_kwargs,
+    )
+    if nwb_checksum != source_checksum:
+        return f"{photon_series.name}: checksum of frames {start_frame}:{end_frame} differs from the source"
+
+    return None
+
+
+def _count_fictrac_rows(file_path: Union[str, Path]) -> int:
+    with open(file_path, "r") as file:
+        num_rows = sum(1 for line in file if line.strip())
+
+    return num_rows
+
+
+def verify_session(
+    nwbfile_path: Union[str, Path],
+    data_dir_path: Union[str, Path],
+    subject_id: str,
+    date_string: str,
+    num_sample_frames: int = 5,
+    num_sample_blocks: int = 50,
+    block_shape: Tuple[int, int, int] = (64, 64, 8),
+    exhaustive: bool = False,
+    checksum_block_bytes: int = 256 * 1024**2,
+    checksum_slab_bytes: int = 16 * 1024**2,
+    timestamps_tolerance: float = 0.01,
+    stub_test: bool = False,
+    max_workers: Optional[int] = None,
+    seed: Optional[int] = None,
+    imaging_file_format: Literal["nifti", "tiff"] = "nifti",
+    verbose: bool = False,
+) -> dict:
+    """
+    Verify a converted NWB file against the source data of the session.
+
+    For every TwoPhotonSeries a random sample of full frames and of voxel blocks is compared against the NIfTI or
+    TIFF files and the timestamps are compared with the ones of the imaging extractors. The number of rows of the
+    FicTrac data is compared with the number of rows in the FicTrac file.
+
+    Parameters
+    ----------
+    nwbfile_path : str or Path
+        The path to the NWB file produced by `session_to_nwb`.
+    data_dir_path : str or Path
+        The directory with the source data, same as in `session_to_nwb`.
+    subject_id : str
+        The name of the fly folder in the imports directory (e.g. "fly2").
+    date_string : str
+        The date of the session in the format YYYYMMDD.
+    num_sample_frames : int, default: 5
+        The number of full frames (volumes) sampled per TwoPhotonSeries.
+    num_sample_blocks : int, default: 50
+        The number of voxel blocks sampled per TwoPhotonSeries, each one from a random frame.
+    block_shape : tuple of int, default: (64, 64, 8)
+        The shape of the voxel blocks in (x - columns, y - rows, z) order.
+    exhaustive : bool, default: False
+        If True, every frame is compared by streaming blocks of frames and comparing their checksums instead of
+        sampling.
+    checksum_block_bytes : int, default: 256 MiB
+        The approximate size of the blocks of frames that are checksummed in the exhaustive mode, a failure reports
+        the frames of the block.
+    checksum_slab_bytes : int, default: 16 MiB
+        The approximate size of the slabs of frames that the blocks are read and hashed in, at least one frame. Each
+        checksum task holds about two slabs in memory.
+    timestamps_tolerance : float, default: 0.01
+        The maximum absolute difference in seconds allowed between the NWB and the source timestamps.
+    stub_test : bool, default: False
+        Set to True if the NWB file was written with `stub_test=True`, only the written frames are verified.
+    max_workers : int, optional
+        The number of threads used for the reads, defaults to the `ThreadPoolExecutor` default, or to 4 in the
+        exhaustive mode to bound the number of checksum tasks in memory.
+    seed : int, optional
+        Seed for the random sampling of frames and blocks.
+    imaging_file_format : "nifti" or "tiff", default: "nifti"
+        The files the raw imaging data was converted from, see `session_to_nwb`. The processed data is always
+        compared against its NIfTI file.
+    verbose : bool, default: False
+
+    Returns
+    -------
+    dict
+        A dictionary with `passed`, the number of checks performed (`num_checks`) and the list of `failures`.
+    """
+    from pynwb import NWBHDF5IO
+    from pynwb.behavior import SpatialSeries
+    from pynwb.ophys import TwoPhotonSeries
+
+    assert imaging_file_format in ("nifti", "tiff"), f"Unknown imaging file format '{imaging_file_format}'!"
+    rng = np.random.default_rng(seed)
+    session_file_paths = get_session_file_paths(
+        data_dir_path=data_dir_path, subject_id=subject_id, date_string=date_string
+    )
+
+    # Source extractors and the timestamps they are expected to have in the NWB file
+    functional_datetime = session_file_paths["session_start_datetime"]
+    extractor_class = (
+        BrezovecMultiPlaneTiffImagingExtractor if imaging_file_format == "tiff" else BrezovecMultiPlaneImagingExtractor
+    )
+    extractors = dict()
+    expected_timestamps = dict()
+    for imaging_source_data in session_file_paths["imaging_source_data"].values():
+        folder_path = imaging_source_data["folder_path"]
+        extractor = extractor_class(folder_path=folder_path, stream_name=imaging_source_data["channel"])
+        series_name = f"TwoPhotonSeries{imaging_source_data['imaging_purpose']}{imaging_source_data['channel']}"
+        extractors[series_name] = extractor
+
+        # The anatomical imaging is shifted to the start of the functional imaging as in the converter
+        xml_file_path = Path(folder_path) / f"{Path(folder_path).name}.xml"
+        series_datetime = read_session_start_time_from_file(xml_file_path)
+        aligned_starting_time = series_datetime.timestamp() - functional_datetime.timestamp()
+        expected_timestamps[series_name] = extractor.get_timestamps() + aligned_starting_time
+
+    # The processed data shares the sampling of the functional imaging
+    processed_extractor = NIfTIImagingExtractor(file_path=session_file_paths["processed_file_path"])
+    extractors["TwoPhotonSeriesFunctionalGreenProcessed"] = processed_extractor
+    expected_timestamps["TwoPhotonSeriesFunctionalGreenProcessed"] = expected_timestamps[
+        "TwoPhotonSeriesFunctionalGreen"
+    ][: processed_extractor.get_num_frames()]
+
+    failures = []
+    num_checks = 0
+    with NWBHDF5IO(str(nwbfile_path), mode="r", load_namespaces=True) as io:
+        nwbfile = io.read()
+        photon_series_list = [obj for obj in nwbfile.objects.values() if isinstance(obj, TwoPhotonSeries)]
+        spatial_series_list = [obj for obj in nwbfile.objects.values() if isinstance(obj, SpatialSeries)]
+
+        missing_series_names = set(extractors) - {photon_series.name for photon_series in photon_series_list}
+        failures.extend(f"{name}: missing from the NWB file" for name in sorted(missing_series_names))
+
+        tasks = []
+        for photon_series in photon_series_list:
+            extractor = extractors.get(photon_series.name)
+            if extractor is None:
+                continue
+
+            num_frames = photon_series.data.shape[0]
+            source_num_frames = extractor.get_num_frames()
+            num_checks += 1
+            frames_match = num_frames <= source_num_frames if stub_test else num_frames == source_num_frames
+            if not frames_match:
+                failures.append(
+                    f"{photon_series.name}: {num_frames} frames in the NWB file but {source_num_frames} in the source"
+                )
+                num_frames = min(num_frames, source_num_frames)
+
+            num_checks += 1
+            nwb_timestamps = _get_series_timestamps(photon_series)[:num_frames]
+            source_timestamps = expected_timestamps[photon_series.name][:num_frames]
+            if nwb_timestamps.size != source_timestamps.size:
+                failures.append(f"{photon_series.name}: the number of timestamps differs from the source")
+            elif not np.allclose(nwb_timestamps, source_timestamps, rtol=0, atol=timestamps_tolerance):
+                max_difference = np.max(np.abs(nwb_timestamps - source_timestamps))
+                failures.append(f"{photon_series.name}: timestamps differ from the source by up to {max_difference} s")
+
+            volume_shape = photon_series.data.shape[1:]
+            if exhaustive:
+                frame_bytes = int(np.prod(volume_shape)) * photon_series.data.dtype.itemsize
+                frames_per_block = max(1, checksum_block_bytes // frame_bytes)
+                frames_per_slab = max(1, checksum_slab_bytes // frame_bytes)
+                for start_frame in range(0, num_frames, frames_per_block):
+                    end_frame = min(start_frame + frames_per_block, num_frames)
+                    tasks.append(
+                        (_check_block_checksum, photon_series, extractor, start_frame, end_frame, frames_per_slab)
+                    )
+                continue
+
+            sample_frames = rng.choice(num_frames, size=min(num_sample_frames, num_frames), replace=False)
+            tasks.extend((_check_frame, photon_series, extractor, int(frame)) for frame in sample_frames)
+            for _ in range(num_sample_blocks):
+                frame = int(rng.integers(num_frames))
+                block = _sample_block(rng=rng, volume_shape=volume_shape, block_shape=block_shape)
+                tasks.append((_check_block, photon_series, extractor, frame, block))
+
+        if verbose:
+            print(f"Running {len(tasks)} data checks over {len(photon_series_list)} TwoPhotonSeries")
+
+        # The tasks only read their data once they run so the number of threads bounds the memory in use
+        if exhaustive and max_workers is None:
+            max_workers = 4
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(*task) for task in tasks]
+            task_failures = [future.result() for future in futures]
+        num_checks += len(tasks)
+        failures.extend(failure for failure in task_failures if failure is not None)
+
+        # All the spatial series of FicTrac have one row per row of the FicTrac file
+        fictrac_num_rows = _count_fictrac_rows(session_file_paths["fictrac_file_path"])
+        for spatial_series in spatial_series_list:
+            num_checks += 1
+            num_rows = spatial_series.data.shape[0]
+            if num_rows != fictrac_num_rows:
+                failures.append(
+                    f"{spatial_series.name}: {num_rows} rows in the NWB file but {fictrac_num_rows} in FicTrac"
+                )
+
+    passed = not failures
+    if verbose:
+        print(f"Verified {nwbfile_path} with {num_checks} checks: {'passed' if passed else 'FAILED'}")
+        for failure in failures:
+            print(failure)
+
+    return dict(passed=passed, num_checks=num_checks, failures=failures)
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="Verify a converted NWB file against the source data of the session.")
+    parser.add_argument("nwbfile_path", type=Path)
+    parser.add_argument("data_dir_path", type=Path)
+    parser.add_argument("subject_id", help="The name of the fly folder in the imports directory (e.g. fly2).")
+    parser.add_argument("date_string", help="The date of the session in the format YYYYMMDD.")
+    parser.add_argument("--num-sample-frames", type=int, default=5)
+    parser.add_argument("--num-sample-blocks", type=int, default=50)
+    parser.add_argument("--block-shape", type=int, nargs=3, default=(64, 64, 8))
+    parser.add_argument(
+        "--exhaustive", action="store_true", help="Compare checksums of every frame instead of sampling."
+    )
+    parser.add_argument("--stub-test", action="store_true")
+    parser.add_argument("--max-workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--imaging-file-format", choices=["nifti", "tiff"], default="nifti")
+    args = parser.parse_args()
+
+    report = verify_session(
+        nwbfile_path=args.nwbfile_path,
+        data_dir_path=args.data_dir_path,
+        subject_id=args.subject_id,
+        date_string=args.date_string,
+        num_sample_frames=args.num_sample_frames,
+        num_sample_blocks=args.num_sample_blocks,
+        block_shape=tuple(args.block_shape),
+        exhaustive=args.exhaustive,
+        stub_test=args.stub_test,
+        max_workers=args.max_workers,
+        seed=args.seed,
+        imaging_file_format=args.imaging_file_format,
+        verbose=True,
+    )
+    sys.exit(0 if report["passed"] else 1)
@@ -0,0 +1,383 @@
+"""Work queue on a shared POSIX filesystem to convert sessions with independent workers on several nodes."""
+
+from pathlib import Path
+from typing import Callable, List, Optional, Union
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+import traceback
+
+
+def get_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class SessionWorkQueue:
+    """
+    A queue of sessions stored as files in a directory of a shared filesystem.
+
+    Every session is registered once in `registered/` and then moves between the `pending/`, `claimed/`, `done/` and
+    `failed/` folders by atomic renames, so only one worker can claim it. The worker that claims a session renames it to
+    `claimed/<session_key>@<worker_id>` and touches the file periodically as a heartbeat. Claims whose heartbeat is
+    older than `heartbeat_timeout` are considered to belong to dead workers and are moved back to `pending/`. A
+    completed claim keeps its name in `done/`, so that the worker whose claim was completed is known.
+
+    The entries of the sessions can carry the estimates of their conversion plans under `plan_keys`. The pending
+    sessions with the longest `runtime_seconds` are claimed first so that the last sessions to finish are short ones.
+    """
+
+    states = ("pending", "claimed", "done", "failed")
+    # Keys of the session entries that are not arguments of the conversion
+    plan_keys = ("runtime_seconds", "recommended_num_workers")
+
+    def __init__(
+        self,
+        queue_dir_path: Union[str, Path],
+        heartbeat_interval: float = 30.0,
+        heartbeat_timeout: float = 600.0,
+    ):
+        """
+        Parameters
+        ----------
+        queue_dir_path : str or Path
+            The directory of the queue, it must be on a filesystem shared by all the workers.
+        heartbeat_interval : float, default: 30.0
+            The seconds between two heartbeats of a worker.
+        heartbeat_timeout : float, default: 600.0
+            The seconds without a heartbeat after which a claim is considered to belong to a dead worker. It should be
+            much larger than `heartbeat_interval` to tolerate slow filesystems.
+        """
+        assert heartbeat_timeout > heartbeat_interval, "'heartbeat_timeout' must be larger than 'heartbeat_interval'!"
+
+        self.queue_dir_path = Path(queue_dir_path)
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        for folder_name in ("registered", "tmp") + self.states:
+            (self.queue_dir_path / folder_name).mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def get_session_key(session: dict) -> str:
+        return f"{session['date_string']}_{session['subject_id']}"
+
+    def _get_filesystem_time(self) -> float:
+        # The clocks of the nodes might differ so the age of the heartbeats is measured with the filesystem clock
+        probe_file_path = self.queue_dir_path / "tmp" / f"clock@{get_worker_id()}"
+        probe_file_path.touch()
+        filesystem_time = probe_file_path.stat().st_mtime
+        probe_file_path.unlink()
+        return filesystem_time
+
+    def get_unregistered_sessions(self, sessions: List[dict]) -> List[dict]:
+        """The sessions that were never added to the queue, so that only those need to be planned."""
+        registered_dir_path = self.queue_dir_path / "registered"
+        return [session for session in sessions if not (registered_dir_path / self.get_session_key(session)).exists()]
+
+    def read_sessions(self) -> List[dict]:
+        """The entries of all the sessions added to the queue, whatever their state."""
+        sessions = []
+        for session_dir_path in sorted((self.queue_dir_path / "registered").iterdir()):
+            try:
+                sessions.append(json.loads((session_dir_path / "session.json").read_text()))
+            except FileNotFoundError:
+                # Another worker is still adding the session
+                continue
+
+        return sessions
+
+    def add_sessions(self, sessions: List[dict]) -> int:
+        """
+        Add sessions to the queue, sessions that were already added before are ignored.
+
+        Parameters
+        ----------
+        sessions : list of dict
+            Each session is a dictionary with the `date_string` and `subject_id` keys and optionally other
+            arguments of the conversion of that session and the estimates of its plan under `plan_keys`.
+
+        Returns
+        -------
+        int
+            The number of sessions added.
+        """
+        num_added_sessions = 0
+        for session in sessions:
+            session_key = self.get_session_key(session)
+            # Creating a directory is atomic, only the first worker to register a session adds it to pending
+            session_dir_path = self.queue_dir_path / "registered" / session_key
+            try:
+                session_dir_path.mkdir()
+            except FileExistsError:
+                continue
+
+            # A copy of the entry stays in the registered folder while the other one moves between the states
+            (session_dir_path / "session.json.tmp").write_text(json.dumps(session))
+            os.rename(session_dir_path / "session.json.tmp", session_dir_path / "session.json")
+            tmp_file_path = self.queue_dir_path / "tmp" / f"{session_key}@{get_worker_id()}"
+            tmp_file_path.write_text(json.dumps(session))
+            os.rename(tmp_file_path, self.queue_dir_path / "pending" / session_key)
+            num_added_sessions += 1
+
+        return num_added_sessions
+
+    def _get_pending_runtime_seconds(self, pending_file_path: Path) -> float:
+        try:
+            return json.loads(pending_file_path.read_text()).get("runtime_seconds", 0.0)
+        except FileNotFoundError:
+            return 0.0
+
+    def claim(self, worker_id: str) -> Optional[Path]:
+        """
+        Claim a pending session, the one with the longest planned runtime first.
+
+        Returns
+        -------
+        Path or None
+            The path of the claim file, or None if there are no pending sessions.
+        """
+        pending_file_paths = sorted((self.queue_dir_path / "pending").iterdir())
+        pending_file_paths.sort(key=self._get_pending_runtime_seconds, reverse=True)
+        for pending_file_path in pending_file_paths:
+            claim_file_path = self.queue_dir_path / "claimed" / f"{pending_file_path.name}@{worker_id}"
+            try:
+                # Renaming keeps the modification time so it is refreshed first to not look like a stale claim
+                os.utime(pending_file_path)
+                os.rename(pending_file_path, claim_file_path)
+            except FileNotFoundError:
+                # Another worker claimed it first
+                continue
+
+            return claim_file_path
+
+        return None
+
+    def reclaim_stale(self) -> List[str]:
+        """
+        Move the sessions claimed by workers that stopped sending heartbeats back to pending.
+
+        Returns
+        -------
+        list of str
+            The keys of the sessions that were moved back to pending.
+        """
+        filesystem_time = self._get_filesystem_time()
+        reclaimed_session_keys = []
+        for claim_file_path in (self.queue_dir_path / "claimed").iterdir():
+            try:
+                heartbeat_age = filesystem_time - claim_file_path.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            if heartbeat_age < self.heartbeat_timeout:
+                continue
+
+            session_key = claim_file_path.name.split("@")[0]
+            try:
+                os.rename(claim_file_path, self.queue_dir_path / "pending" / session_key)
+            except FileNotFoundError:
+                # The worker finished or another worker reclaimed it first
+                continue
+            reclaimed_session_keys.append(session_key)
+
+        return reclaimed_session_keys
+
+    def heartbeat(self, claim_file_path: Path) -> bool:
+        """Touch the claim file, returns False if the claim was lost."""
+        try:
+            os.utime(claim_file_path)
+        except FileNotFoundError:
+            return False
+
+        return True
+
+    def read_session(self, claim_file_path: Path) -> dict:
+        return json.loads(Path(claim_file_path).read_text())
+
+    def complete(self, claim_file_path: Path) -> bool:
+        """Mark a claimed session as done, returns False if the claim was lost to another worker."""
+        try:
+            os.rename(claim_file_path, self.queue_dir_path / "done" / claim_file_path.name)
+        except FileNotFoundError:
+            return False
+
+        return True
+
+    def get_done_claim_names(self) -> List[str]:
+        """The names of the claims that were completed, `<session_key>@<worker_id>`."""
+        return sorted(path.name for path in (self.queue_dir_path / "done").iterdir())
+
+    def fail(self, claim_file_path: Path, message: str) -> bool:
+        """Mark a claimed session as failed, the message is written next to it."""
+        session_key = claim_file_path.name.split("@")[0]
+        (self.queue_dir_path / "failed" / f"{session_key}.log").write_text(message)
+        try:
+            os.rename(claim_file_path, self.queue_dir_path / "failed" / session_key)
+        except FileNotFoundError:
+            return False
+
+        return True
+
+    def get_status(self) -> dict:
+        """The number of sessions in each state."""
+        status = dict()
+        for state in self.states:
+            status[state] = sum(1 for path in (self.queue_dir_path / state).iterdir() if path.suffix != ".log")
+
+        return status
+
+
+class _HeartbeatThread(threading.Thread):
+    def __init__(self, work_queue: SessionWorkQueue, claim_file_path: Path):
+        super().__init__(daemon=True)
+        self.work_queue = work_queue
+        self.claim_file_path = claim_file_path
+        self.claim_lost = False
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(timeout=self.work_queue.heartbeat_interval):
+            if not self.work_queue.heartbeat(self.claim_file_path):
+                self.claim_lost = True
+                break
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def _move_claim_output(claim_output_dir_path: Path, output_dir_path: Path):
+    """Move the files written for a claim into the output directory, keeping their relative paths."""
+    for file_path in sorted(path for path in claim_output_dir_path.rglob("*") if path.is_file()):
+        final_file_path = output_dir_path / file_path.relative_to(claim_output_dir_path)
+        final_file_path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.rename(file_path, final_file_path)
+        except FileNotFoundError:
+            # Another worker is finishing the same move
+            continue
+    shutil.rmtree(claim_output_dir_path, ignore_errors=True)
+
+
+def _finish_completed_moves(work_queue: SessionWorkQueue, output_dir_path: Path) -> List[str]:
+    """Move the output of the completed claims of workers that died before moving it, returns their session keys."""
+    done_claim_names = set(work_queue.get_done_claim_names())
+    finished_session_keys = []
+    for claim_output_dir_path in sorted(output_dir_path.glob(".*@*")):
+        claim_name = claim_output_dir_path.name[1:]
+        if claim_name in done_claim_names:
+            _move_claim_output(claim_output_dir_path=claim_output_dir_path, output_dir_path=output_dir_path)
+            finished_session_keys.append(claim_name.split("@")[0])
+
+    return finished_session_keys
+
+
+def run_worker(
+    queue_dir_path: Union[str, Path],
+    convert_session: Callable,
+    output_dir_path: Union[str, Path],
+    heartbeat_interval: float = 30.0,
+    heartbeat_timeout: float = 600.0,
+    poll_interval: float = 60.0,
+    worker_id: Optional[str] = None,
+    conversion_kwargs: Optional[dict] = None,
+    verbose: bool = False,
+) -> List[str]:
+    """
+    Claim and convert sessions from the queue until there are none left.
+
+    The worker keeps polling while other workers hold claims so it can take over the sessions of workers that die.
+
+    A worker that is considered dead by mistake, for example because of a slow filesystem, keeps converting while
+    another worker converts the same session. So each claim is converted into its own hidden directory inside
+    `output_dir_path`, and its files are only moved into `output_dir_path` after the session is marked as done, which
+    only one of the workers can do. The output of the worker that lost the claim is deleted. A worker that dies after
+    marking its session as done but before moving its files leaves them in the hidden directory of its claim, the
+    next worker to start moves them.
+
+    Parameters
+    ----------
+    queue_dir_path : str or Path
+        The directory of the queue, see `SessionWorkQueue`.
+    convert_session : callable
+        Called with the items of each session dictionary except the `plan_keys`, the `conversion_kwargs` and an `output_dir_path` keyword
+        argument, for example `session_to_nwb`.
+    output_dir_path : str or Path
+        The directory where the converted files are moved to.
+    heartbeat_interval : float, default: 30.0
+    heartbeat_timeout : float, default: 600.0
+    poll_interval : float, default: 60.0
+        The seconds to wait before looking again for work when all the remaining sessions are claimed by other workers.
+    worker_id : str, optional
+        Defaults to the host name and the process id.
+    conversion_kwargs : dict, optional
+        Other keyword arguments of `convert_session`, the same for all the sessions.
+    verbose : bool, default: False
+        Print the progress of the worker.
+
+    Returns
+    -------
+    list of str
+        The keys of the sessions converted by this worker.
+    """
+    worker_id = worker_id or get_worker_id()
+    conversion_kwargs = conversion_kwargs or dict()
+    output_dir_path = Path(output_dir_path)
+    work_queue = SessionWorkQueue(
+        queue_dir_path=queue_dir_path,
+        heartbeat_interval=heartbeat_interval,
+        heartbeat_timeout=heartbeat_timeout,
+    )
+
+    finished_session_keys = _finish_completed_moves(work_queue=work_queue, output_dir_path=output_dir_path)
+    if verbose and finished_session_keys:
+        print(f"Worker {worker_id} moved the output of the sessions of dead workers: {finished_session_keys}")
+
+    converted_session_keys = []
+    while True:
+        reclaimed_session_keys = work_queue.reclaim_stale()
+        if verbose and reclaimed_session_keys:
+            print(f"Worker {worker_id} moved the sessions of dead workers back to pending: {reclaimed_session_keys}")
+
+        claim_file_path = work_queue.claim(worker_id=worker_id)
+        if claim_file_path is None:
+            if work_queue.get_status()["claimed"] == 0:
+                break
+            time.sleep(poll_interval)
+            continue
+
+        session = work_queue.read_session(claim_file_path)
+        session_key = work_queue.get_session_key(session)
+        session_kwargs = {key: value for key, value in session.items() if key not in work_queue.plan_keys}
+        if verbose:
+            print("-" * 80)
+            print(f"Worker {worker_id} converting session {session_key}")
+
+        # On the same filesystem as the output directory so the files can be moved there with a rename
+        claim_output_dir_path = output_dir_path / f".{claim_file_path.name}"
+        shutil.rmtree(claim_output_dir_path, ignore_errors=True)
+        heartbeat_thread = _HeartbeatThread(work_queue=work_queue, claim_file_path=claim_file_path)
+        heartbeat_thread.start()
+        try:
+            convert_session(**session_kwargs, **conversion_kwargs, output_dir_path=claim_output_dir_path)
+        except Exception:
+            heartbeat_thread.stop()
+            shutil.rmtree(claim_output_dir_path, ignore_errors=True)
+            work_queue.fail(claim_file_path, message=traceback.format_exc())
+            if verbose:
+                print(f"Worker {worker_id} failed to convert session {session_key}")
+            continue
+        heartbeat_thread.stop()
+
+        if heartbeat_thread.claim_lost or not work_queue.complete(claim_file_path):
+            shutil.rmtree(claim_output_dir_path, ignore_errors=True)
+            if verbose:
+                print(f"Worker {worker_id} lost the claim of session {session_key} to another worker")
+            continue
+        _move_claim_output(claim_output_dir_path=claim_output_dir_path, output_dir_path=output_dir_path)
+        converted_session_keys.append(session_key)
+
+    if verbose:
+        print(f"Worker {worker_id} finished, queue status: {work_queue.get_status()}")
+
+    return converted_session_keys
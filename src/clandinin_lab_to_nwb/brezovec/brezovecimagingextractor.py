@@ -1,3 +1,4 @@
+from collections import defaultdict
 from pathlib import Path
 from typing import Optional, Tuple, Union, List, Dict
 from xml.etree import ElementTree
@@ -7,34 +8,7 @@ from roiextractors.imagingextractor import ImagingExtractor
 from roiextractors.extraction_tools import PathType, DtypeType
 from neuroconv.utils import calculate_regular_series_rate
 
-
-def get_channels_from_first_frame(xml_file):
-    """
-    Extract channel and channelName attributes from the File tags within the first Frame tag.
-
-    Parameters
-    ----------
-    xml_file : str or Path
-        Path to the XML file.
-
-    Returns
-    -------
-    list of tuple
-        A list containing tuples. Each tuple consists of (channel, channelName) attributes.
-    """
-
-    file_attributes_list = []
-    for event, elem in ElementTree.iterparse(xml_file, events=("start", "end")):
-        # We only need one frame so get out out of the loop when the first Frame tag is closed
-        if elem.tag == "Frame" and event == "end":
-            break
-
-        # For every file we extract the channel and channelName attributes and then clear the element
-        if elem.tag == "File" and event == "end":
-            file_attributes_list.append((elem.attrib.get("channel"), elem.attrib.get("channelName")))
-            elem.clear()
-
-    return file_attributes_list
+from clandinin_lab_to_nwb.brezovec.brezovec_bruker_xml import get_channels_from_first_frame
 
 
 def _parse_xml(folder_path: PathType) -> ElementTree.Element:
@@ -55,6 +29,102 @@ def _get_xml_file_path(folder_path: PathType) -> Path:
     return xml_file_path
 
 
+def _get_streams(folder_path: PathType) -> dict:
+    xml_file_path = _get_xml_file_path(folder_path)
+    channel_info = get_channels_from_first_frame(xml_file_path)
+    channel_info_formated = {f"{channel_name}": f"{channel}" for channel, channel_name in channel_info}
+    streams = {"channel_streams": channel_info_formated}
+
+    return streams
+
+
+def _determine_imaging_is_volumetric(xml_root: ElementTree.Element) -> bool:
+    """
+    Determines whether imaging is volumetric based on 'zDevice' configuration value.
+    The value is expected to be '1' for volumetric and '0' for single plane images.
+    """
+    z_device_element = xml_root.find(".//PVStateValue[@key='zDevice']")
+    is_volumetric = bool(int(z_device_element.attrib["value"]))
+
+    return is_volumetric
+
+
+def _get_xml_metadata(xml_root: ElementTree.Element) -> Dict[str, Union[str, List[Dict[str, str]]]]:
+    """
+    Parses the metadata in the root element that are under "PVStateValue" tag into
+    a dictionary.
+    """
+    xml_metadata = dict()
+    xml_metadata.update(**xml_root.attrib)
+    for child in xml_root.findall(".//PVStateValue"):
+        metadata_root_key = child.attrib["key"]
+        if "value" in child.attrib:
+            if metadata_root_key in xml_metadata:
+                continue
+            xml_metadata[metadata_root_key] = child.attrib["value"]
+        else:
+            xml_metadata[metadata_root_key] = []
+            for indexed_value in child:
+                if "description" in indexed_value.attrib:
+                    xml_metadata[child.attrib["key"]].append(
+                        {indexed_value.attrib["description"]: indexed_value.attrib["value"]}
+                    )
+                elif "value" in indexed_value.attrib:
+                    xml_metadata[child.attrib["key"]].append(
+                        {indexed_value.attrib["index"]: indexed_value.attrib["value"]}
+                    )
+                else:
+                    for subindexed_value in indexed_value:
+                        if "description" in subindexed_value.attrib:
+                            xml_metadata[metadata_root_key].append(
+                                {subindexed_value.attrib["description"]: subindexed_value.attrib["value"]}
+                            )
+                        else:
+                            xml_metadata[child.attrib["key"]].append(
+                                {indexed_value.attrib["index"]: subindexed_value.attrib["value"]}
+                            )
+    return xml_metadata
+
+
+def _index_tiff_pages(file_path: PathType, page_indices: List[int]) -> List[Tuple[Optional[int], tuple, np.dtype]]:
+    """
+    Reads the position of the data of some pages of a TIFF file.
+
+    Returns
+    -------
+    list of tuple
+        The data offset, shape and dtype of each page. The offset is None for the pages that are compressed or not
+        stored contiguously, which can not be read directly.
+    """
+    from tifffile import TiffFile
+
+    page_entries = []
+    with TiffFile(file_path) as tiff_file:
+        for page_index in page_indices:
+            page = tiff_file.pages[page_index]
+            dtype = np.dtype(page.dtype).newbyteorder(tiff_file.byteorder)
+            offset = page.dataoffsets[0] if page.is_contiguous and page.compression == 1 else None
+            page_entries.append((offset, page.shape, dtype))
+
+    return page_entries
+
+
+def _read_tiff_page(
+    file_path: PathType, page_index: int, offset: Optional[int], shape: tuple, dtype: np.dtype
+) -> np.ndarray:
+    """
+    Reads a page of a TIFF file from the position of its data, without parsing the file.
+    """
+    if offset is None:
+        from tifffile import TiffFile
+
+        with TiffFile(file_path) as tiff_file:
+            return tiff_file.pages[page_index].asarray()
+
+    page = np.fromfile(file_path, dtype=dtype, count=int(np.prod(shape)), offset=offset)
+    return page.reshape(shape)
+
+
 class NIfTIImagingExtractor(ImagingExtractor):
     def __init__(
         self, file_path: PathType, sampling_frequency: Optional[float] = None, channel_name: Optional[str] = None
@@ -120,23 +190,11 @@ class BrezovecMultiPlaneImagingExtractor(NIfTIImagingExtractor):
 
     @classmethod
     def get_streams(cls, folder_path: PathType) -> dict:
-        xml_file_path = _get_xml_file_path(folder_path)
-        channel_info = get_channels_from_first_frame(xml_file_path)
-        channel_info_formated = {f"{channel_name}": f"{channel}" for channel, channel_name in channel_info}
-        streams = {"channel_streams": channel_info_formated}
-
-        return streams
+        return _get_streams(folder_path=folder_path)
 
     @classmethod
     def _determine_imaging_is_volumetric(cls, xml_root: ElementTree.Element) -> bool:
-        """
-        Determines whether imaging is volumetric based on 'zDevice' configuration value.
-        The value is expected to be '1' for volumetric and '0' for single plane images.
-        """
-        z_device_element = xml_root.find(".//PVStateValue[@key='zDevice']")
-        is_volumetric = bool(int(z_device_element.attrib["value"]))
-
-        return is_volumetric
+        return _determine_imaging_is_volumetric(xml_root=xml_root)
 
     def __init__(
         self,
@@ -221,37 +279,189 @@ class BrezovecMultiPlaneImagingExtractor(NIfTIImagingExtractor):
         return 1  # len(self.get_channel_names())
 
     def _get_xml_metadata(self) -> Dict[str, Union[str, List[Dict[str, str]]]]:
+        return _get_xml_metadata(xml_root=self._xml_root)
+
+
+class BrezovecTiffImagingExtractor(ImagingExtractor):
+    """Base extractor that reads the Bruker TIFF files listed in the `File` elements of the XML file directly,
+    skipping the conversion to NIfTI. The index from frames and planes to the files and the offsets of the pages in
+    them is built once, so every page is read with a single read of its data."""
+
+    extractor_name = "BrezovecTiffImaging"
+    is_writable = False
+    mode = "folder"
+
+    @classmethod
+    def get_streams(cls, folder_path: PathType) -> dict:
+        return _get_streams(folder_path=folder_path)
+
+    def __init__(self, folder_path: PathType, stream_name: str):
+        """
+        Create an extractor from the TIFF files and the XML configuration file produced by the Bruker system.
+
+        Parameters
+        ----------
+        folder_path : PathType
+            The path to the folder that contains the TIFF image files (.ome.tif) and configuration files (.xml).
+        stream_name: str
+            The name of the recording channel.
+        """
+        super().__init__()
+        self.folder_path = Path(folder_path)
+        self._xml_root = _parse_xml(folder_path=folder_path)
+        self._is_volumetric = _determine_imaging_is_volumetric(self._xml_root)
+
+        self.stream_name = stream_name
+        streams = self.get_streams(folder_path=folder_path)
+        self._channel_names = list(streams["channel_streams"].keys())
+        assert (
+            stream_name in self._channel_names
+        ), f"The selected stream '{stream_name}' is not in the available channel stream '{self._channel_names}'!"
+
+        # Every Frame element is one plane of a volume, volumes are Sequence elements for volumetric imaging
+        first_sequence_element = self._xml_root.find(".//Sequence")
+        self._num_planes = len(first_sequence_element.findall("Frame")) if self._is_volumetric else 1
+
+        frame_elements = self._xml_root.findall(".//Frame")
+        page_locations = []
+        for frame_element in frame_elements:
+            file_element = next(
+                element for element in frame_element.findall("File") if element.attrib["channelName"] == stream_name
+            )
+            file_path = self.folder_path / file_element.attrib["filename"]
+            page_index = int(file_element.attrib.get("page", 1)) - 1
+            page_locations.append((file_path, page_index))
+        # We use relative time as that is what the authors do in their code
+        self._relative_times = [float(frame_element.attrib["relativeTime"]) for frame_element in frame_elements]
+        self._num_frames = len(frame_elements) // self._num_planes
+
+        # Each file is parsed once here so that reading a page is a single read at the offset of its data
+        page_indices_per_file = defaultdict(list)
+        for file_path, page_index in page_locations:
+            page_indices_per_file[file_path].append(page_index)
+        page_entries = dict()
+        for file_path, page_indices in page_indices_per_file.items():
+            assert file_path.is_file(), f"The TIFF image file '{file_path}' is missing."
+            file_page_entries = _index_tiff_pages(file_path=file_path, page_indices=page_indices)
+            page_entries.update(
+                ((file_path, page_index), page_entry) for page_index, page_entry in zip(page_indices, file_page_entries)
+            )
+        self._page_index = [
+            (file_path, page_index) + page_entries[(file_path, page_index)] for file_path, page_index in page_locations
+        ]
+
+        _, _, _, first_page_shape, first_page_dtype = self._page_index[0]
+        self._num_rows, self._num_columns = first_page_shape
+        # The pages are converted to the native byte order when they are copied into the video
+        self._dtype = first_page_dtype.newbyteorder("=")
+
+        sampling_frequency = calculate_regular_series_rate(self.get_timestamps())
+        assert sampling_frequency is not None, "Could not determine the frame rate from the XML file."
+        self._sampling_frequency = sampling_frequency
+        self.xml_metadata = _get_xml_metadata(xml_root=self._xml_root)
+
+    def _read_page(self, frame_element_index: int) -> np.ndarray:
+        file_path, page_index, offset, shape, dtype = self._page_index[frame_element_index]
+        return _read_tiff_page(file_path=file_path, page_index=page_index, offset=offset, shape=shape, dtype=dtype)
+
+    def _read_frames(self, start_frame: int, end_frame: int) -> np.ndarray:
+        video = np.empty(
+            (end_frame - start_frame, self._num_rows, self._num_columns, self._num_planes), dtype=self._dtype
+        )
+        for frame_index in range(start_frame, end_frame):
+            for plane_index in range(self._num_planes):
+                page = self._read_page(frame_element_index=frame_index * self._num_planes + plane_index)
+                video[frame_index - start_frame, :, :, plane_index] = page
+
+        return video
+
+    def get_timestamps(self) -> np.ndarray:
+        timestamps = self._relative_times[:: self._num_planes][: self._num_frames]
+        return np.asarray(timestamps)
+
+    def get_num_frames(self) -> int:
+        return self._num_frames
+
+    def get_dtype(self) -> DtypeType:
+        return self._dtype
+
+    def get_sampling_frequency(self) -> float:
+        return self._sampling_frequency
+
+    # Since we define one TwoPhotonSeries per channel, here it should return the name of the single channel
+    def get_channel_names(self) -> list:
+        return [self.stream_name]
+
+    def get_num_channels(self) -> int:
+        return 1
+
+
+class BrezovecMultiPlaneTiffImagingExtractor(BrezovecTiffImagingExtractor):
+    """Specialized extractor for the Brezovec conversion project.
+    Reads volumes from the Bruker TIFF files with the same output as BrezovecMultiPlaneImagingExtractor."""
+
+    extractor_name = "BrezovecMultiPlaneTiffImaging"
+
+    def __init__(self, folder_path: PathType, stream_name: str):
+        super().__init__(folder_path=folder_path, stream_name=stream_name)
+        assert self._is_volumetric, (
+            f"{self.extractor_name}Extractor is for volumetric imaging. "
+            "For single imaging plane data use BrezovecSinglePlaneImagingExtractor."
+        )
+
+    def get_plane_acquisition_rate(self, cycle) -> float:
         """
-        Parses the metadata in the root element that are under "PVStateValue" tag into
-        a dictionary.
+        Determines the plane acquisition rate from the difference in relative timestamps of frame elements in one cycle or sequence element.
         """
-        xml_metadata = dict()
-        xml_metadata.update(**self._xml_root.attrib)
-        for child in self._xml_root.findall(".//PVStateValue"):
-            metadata_root_key = child.attrib["key"]
-            if "value" in child.attrib:
-                if metadata_root_key in xml_metadata:
-                    continue
-                xml_metadata[metadata_root_key] = child.attrib["value"]
-            else:
-                xml_metadata[metadata_root_key] = []
-                for indexed_value in child:
-                    if "description" in indexed_value.attrib:
-                        xml_metadata[child.attrib["key"]].append(
-                            {indexed_value.attrib["description"]: indexed_value.attrib["value"]}
-                        )
-                    elif "value" in indexed_value.attrib:
-                        xml_metadata[child.attrib["key"]].append(
-                            {indexed_value.attrib["index"]: indexed_value.attrib["value"]}
-                        )
-                    else:
-                        for subindexed_value in indexed_value:
-                            if "description" in subindexed_value.attrib:
-                                xml_metadata[metadata_root_key].append(
-                                    {subindexed_value.attrib["description"]: subindexed_value.attrib["value"]}
-                                )
-                            else:
-                                xml_metadata[child.attrib["key"]].append(
-                                    {indexed_value.attrib["index"]: subindexed_value.attrib["value"]}
-                                )
-        return xml_metadata
+        plane_acquisition_rate = calculate_regular_series_rate(
+            np.array(self._relative_times[self._num_planes * (cycle - 1) : self._num_planes * cycle])
+        )
+        return plane_acquisition_rate
+
+    def get_video(
+        self, start_frame: Optional[int] = None, end_frame: Optional[int] = None, channel: int = 0
+    ) -> np.ndarray:
+        """
+        Returns the volumes in the roiextractors convention:
+        (t, y - rows, x - columns, z)
+        """
+        if start_frame is not None and end_frame is not None and start_frame == end_frame:
+            return self._read_frames(start_frame=start_frame, end_frame=start_frame + 1)[0]
+
+        end_frame = end_frame or self.get_num_frames()
+        start_frame = start_frame or 0
+        return self._read_frames(start_frame=start_frame, end_frame=end_frame)
+
+    def get_image_size(self) -> Tuple[int, int, int]:
+        return (self._num_rows, self._num_columns, self._num_planes)
+
+
+class BrezovecSinglePlaneImagingExtractor(BrezovecTiffImagingExtractor):
+    """Specialized extractor for the Brezovec conversion project.
+    Reads single plane imaging from the Bruker TIFF files."""
+
+    extractor_name = "BrezovecSinglePlaneImaging"
+
+    def __init__(self, folder_path: PathType, stream_name: str):
+        super().__init__(folder_path=folder_path, stream_name=stream_name)
+        assert not self._is_volumetric, (
+            f"{self.extractor_name}Extractor is for single plane imaging. "
+            "For volumetric imaging data use BrezovecMultiPlaneTiffImagingExtractor."
+        )
+
+    def get_video(
+        self, start_frame: Optional[int] = None, end_frame: Optional[int] = None, channel: int = 0
+    ) -> np.ndarray:
+        """
+        Returns the frames in the roiextractors convention:
+        (t, y - rows, x - columns)
+        """
+        if start_frame is not None and end_frame is not None and start_frame == end_frame:
+            return self._read_frames(start_frame=start_frame, end_frame=start_frame + 1)[0, ..., 0]
+
+        end_frame = end_frame or self.get_num_frames()
+        start_frame = start_frame or 0
+        return self._read_frames(start_frame=start_frame, end_frame=end_frame)[..., 0]
+
+    def get_image_size(self) -> Tuple[int, int]:
+        return (self._num_rows, self._num_columns)
@@ -1,20 +1,538 @@
 from dateutil.parser import parse
+from clandinin_lab_to_nwb.brezovec.brezovec_bruker_xml import read_session_start_time_from_file
 from clandinin_lab_to_nwb.brezovec.brezovecimagingextractor import (
     BrezovecMultiPlaneImagingExtractor,
+    BrezovecMultiPlaneTiffImagingExtractor,
     NIfTIImagingExtractor,
 )
+from collections import deque
+from copy import deepcopy
 from pathlib import Path
-from datetime import datetime
+from typing import Dict, List
+import itertools
+import math
+import queue
+import threading
+import time
+import weakref
 
 import numpy as np
 
+from hdmf.data_utils import DataChunk
 from neuroconv.datainterfaces.ophys.baseimagingextractorinterface import BaseImagingExtractorInterface
 from neuroconv.utils import FolderPathType, FilePathType
-from neuroconv.utils.dict import DeepDict
-from typing import Literal
+from neuroconv.tools.roiextractors.imagingextractordatachunkiterator import ImagingExtractorDataChunkIterator
+from neuroconv.utils.dict import DeepDict, dict_deep_update
+from typing import Literal, Optional, Tuple
 
+from pynwb import NWBFile
 
-class NiftiImagingInterface(BaseImagingExtractorInterface):
+
+# The size of the reads that fill a buffer, so that the extractors do not allocate a temporary copy of the buffer
+READ_SLAB_BYTES = 64 * 1024**2
+
+
+def _get_unless_stopped(buffers: queue.Queue, stop_event: threading.Event):
+    while not stop_event.is_set():
+        try:
+            return buffers.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return None
+
+
+def _read_video_into(imaging_extractor, start_frame: int, end_frame: int, video: np.ndarray):
+    frame_bytes = max(1, video[0].nbytes)
+    slab_frames = max(1, READ_SLAB_BYTES // frame_bytes)
+    for slab_start in range(start_frame, end_frame, slab_frames):
+        slab_end = min(slab_start + slab_frames, end_frame)
+        video[slab_start - start_frame : slab_end - start_frame] = imaging_extractor.get_video(
+            start_frame=slab_start, end_frame=slab_end
+        )
+
+
+def _read_buffers_ahead(
+    imaging_extractor,
+    frame_ranges: List[Tuple[int, int]],
+    free_buffers: queue.Queue,
+    ready_buffers: queue.Queue,
+    stop_event: threading.Event,
+    wait_times: Dict[str, float],
+):
+    # This does not keep a reference to the iterator so that it can be garbage collected while the thread runs
+    for start_frame, end_frame in frame_ranges:
+        wait_start = time.perf_counter()
+        buffer = _get_unless_stopped(free_buffers, stop_event)
+        wait_times["write_wait_time"] += time.perf_counter() - wait_start
+        if buffer is None:
+            return
+
+        try:
+            _read_video_into(imaging_extractor, start_frame, end_frame, buffer[: end_frame - start_frame])
+            ready_buffers.put((start_frame, end_frame, buffer))
+        except Exception as exception:
+            ready_buffers.put(exception)
+            return
+
+
+def _stop_thread(stop_event: threading.Event, thread: threading.Thread):
+    stop_event.set()
+    thread.join()
+
+
+class PrefetchingImagingExtractorDataChunkIterator(ImagingExtractorDataChunkIterator):
+    """
+    Data chunk iterator that reads the next buffers of frames in a background thread while the current buffer is
+    compressed and written.
+
+    The buffers are a ring of `num_buffers_ahead + 2` arrays, allocated once when the first buffer is requested: the
+    one being written, the ones waiting and the one being read. The background thread fills a free array in slabs of
+    frames, and the array is given back to the thread once the writer has moved to the next buffer, so that the
+    conversion does not allocate a new buffer for every call to `get_video`.
+    """
+
+    def __init__(self, imaging_extractor, num_buffers_ahead: int = 1, verbose: bool = False, **iterator_options):
+        """
+        Parameters
+        ----------
+        imaging_extractor : ImagingExtractor
+        num_buffers_ahead : int, default: 1
+            The number of buffers read ahead in the background thread, 0 disables the prefetching.
+        verbose : bool, default: False
+            If True, the read and write wait times are printed once the last buffer has been used.
+        **iterator_options
+            See `ImagingExtractorDataChunkIterator`.
+        """
+        super().__init__(imaging_extractor=imaging_extractor, **iterator_options)
+        self.num_buffers_ahead = num_buffers_ahead
+        self.verbose = verbose
+
+        # The buffers are requested in frame order, the ones smaller than the image share the frames they read
+        num_frames = self.maxshape[0]
+        buffer_frames = self.buffer_shape[0]
+        self._frame_ranges = [
+            (start_frame, min(start_frame + buffer_frames, num_frames))
+            for start_frame in range(0, num_frames, buffer_frames)
+        ]
+        self._next_range_index = 0
+        self._current_video = None  # Tuple of (start_frame, end_frame, video) of the buffer in use
+        self._current_buffer = None  # The array of the ring that holds the buffer in use
+
+        # Time that the writer waited for buffers to be read and that the reader waited for the writer to free a buffer
+        self.read_wait_time = 0.0
+        self._wait_times = dict(write_wait_time=0.0)
+        self._free_buffers = None
+        self._ready_buffers = None
+        self._stop_event = None
+        self._thread = None
+        self._finalizer = None
+
+    @property
+    def write_wait_time(self) -> float:
+        return self._wait_times["write_wait_time"]
+
+    def _start_prefetching(self):
+        # The ring is allocated with the first buffer so that series that are written later do not hold memory
+        buffer_shape = (self.buffer_shape[0],) + tuple(self.imaging_extractor.get_image_size())
+        self._free_buffers = queue.Queue()
+        for _ in range(self.num_buffers_ahead + 2):
+            self._free_buffers.put(np.empty(buffer_shape, dtype=self.imaging_extractor.get_dtype()))
+        self._ready_buffers = queue.Queue()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(
+            target=_read_buffers_ahead,
+            args=(
+                self.imaging_extractor,
+                self._frame_ranges,
+                self._free_buffers,
+                self._ready_buffers,
+                self._stop_event,
+                self._wait_times,
+            ),
+            daemon=True,
+        )
+        self._thread.start()
+        # The thread is also stopped when the iteration ends early, for example when writing fails
+        self._finalizer = weakref.finalize(self, _stop_thread, self._stop_event, self._thread)
+
+    def close(self):
+        """Stop and join the background thread and release the buffers that it does not use anymore."""
+        if self._finalizer is not None:
+            self._finalizer()
+        self._free_buffers = None
+        self._ready_buffers = None
+
+    def _release_current_buffer(self):
+        # The writer has written all the chunks of the buffer in use when it requests another one
+        if self._current_buffer is not None and self._free_buffers is not None:
+            self._free_buffers.put(self._current_buffer)
+        self._current_buffer = None
+        self._current_video = None
+
+    def _get_video(self, start_frame: int, end_frame: int) -> np.ndarray:
+        if self._current_video is not None and self._current_video[:2] == (start_frame, end_frame):
+            return self._current_video[2]
+
+        is_next_range = self._next_range_index < len(self._frame_ranges) and self._frame_ranges[
+            self._next_range_index
+        ] == (start_frame, end_frame)
+        self._release_current_buffer()
+        if self.num_buffers_ahead == 0 or not is_next_range:
+            return self.imaging_extractor.get_video(start_frame=start_frame, end_frame=end_frame)
+
+        if self._thread is None:
+            self._start_prefetching()
+
+        wait_start = time.perf_counter()
+        ready_buffer = self._ready_buffers.get()
+        self.read_wait_time += time.perf_counter() - wait_start
+        if isinstance(ready_buffer, Exception):
+            self.close()
+            raise ready_buffer
+
+        start_frame, end_frame, self._current_buffer = ready_buffer
+        self._current_video = (start_frame, end_frame, self._current_buffer[: end_frame - start_frame])
+        self._next_range_index += 1
+        if self._next_range_index == len(self._frame_ranges):
+            self.close()
+            if self.verbose:
+                self._print_prefetch_statistics()
+
+        return self._current_video[2]
+
+    def _get_data(self, selection: Tuple[slice]) -> np.ndarray:
+        data = self._get_video(start_frame=selection[0].start, end_frame=selection[0].stop)
+        tranpose_axes = (0, 2, 1) if len(data.shape) == 3 else (0, 2, 1, 3)
+        return data.transpose(tranpose_axes)[(slice(0, self.buffer_shape[0]),) + selection[1:]]
+
+    def _print_prefetch_statistics(self):
+        statistics = self.get_prefetch_statistics()
+        bound = "I/O-bound" if statistics["read_wait_time"] > statistics["write_wait_time"] else "CPU-bound"
+        print(
+            f"Prefetching waited {statistics['read_wait_time']:.2f} seconds for reads and "
+            f"{statistics['write_wait_time']:.2f} seconds for writes, the conversion is {bound}"
+        )
+
+    def get_prefetch_statistics(self) -> Dict[str, float]:
+        """
+        Get the accumulated wait times of the prefetching.
+
+        Returns
+        -------
+        dict
+            `read_wait_time` is the time in seconds that the writer waited for buffers to be read, a large value means
+            that the conversion is I/O-bound. `write_wait_time` is the time in seconds that the background thread
+            waited for the writer to free a buffer, a large value means that the conversion is CPU-bound.
+        """
+        return dict(read_wait_time=self.read_wait_time, write_wait_time=self.write_wait_time)
+
+
+class FillValueSkippingDataChunkIterator(PrefetchingImagingExtractorDataChunkIterator):
+    """
+    Data chunk iterator that splits every buffer into chunks and does not return the chunks where all the values are
+    the fill value, so they are never allocated in the file and read back as the fill value of the dataset.
+
+    Only the chunks that are outside of the mask are checked, the chunks that overlap the mask are always written.
+    By default the chunks tile the image in the spatial dimensions so that the chunks outside of the mask are empty.
+    The chunks are as deep in time as the default chunks that span the whole plane, so reading a few frames of a
+    voxel does not decompress more frames than with those.
+    """
+
+    def __init__(
+        self,
+        imaging_extractor,
+        mask: Optional[np.ndarray] = None,
+        fill_value: float = 0.0,
+        spatial_chunk_shape: Tuple[int, ...] = (64, 64, 1),
+        num_buffers_ahead: int = 1,
+        verbose: bool = False,
+        **iterator_options,
+    ):
+        """
+        Parameters
+        ----------
+        imaging_extractor : ImagingExtractor
+        mask : np.ndarray, optional
+            Boolean array with the shape of the frames in the NWB convention (width, height[, depth]) that is True
+            for the voxels that can have values different from the fill value. By default every chunk is checked.
+        fill_value : float, default: 0.0
+            The fill value of the dataset.
+        spatial_chunk_shape : tuple of int, default: (64, 64, 1)
+            The spatial shape of the chunks when `chunk_shape` is not given.
+        num_buffers_ahead : int, default: 1
+            See `PrefetchingImagingExtractorDataChunkIterator`.
+        verbose : bool, default: False
+            Print the number of skipped chunks and the bytes and time saved when the iteration ends.
+        **iterator_options
+            See `ImagingExtractorDataChunkIterator`.
+        """
+        self.fill_value = fill_value
+        self.spatial_chunk_shape = spatial_chunk_shape
+        super().__init__(
+            imaging_extractor=imaging_extractor,
+            num_buffers_ahead=num_buffers_ahead,
+            verbose=verbose,
+            **iterator_options,
+        )
+
+        chunk_grid_shape = [
+            math.ceil(axis_length / chunk_length)
+            for axis_length, chunk_length in zip(self.maxshape[1:], self.chunk_shape[1:])
+        ]
+        if mask is None:
+            self._is_chunk_outside_mask = np.ones(chunk_grid_shape, dtype=bool)
+        else:
+            assert mask.shape == tuple(
+                self.maxshape[1:]
+            ), f"The shape of the mask {mask.shape} does not match the shape of the frames {self.maxshape[1:]}!"
+            self._is_chunk_outside_mask = np.ones(chunk_grid_shape, dtype=bool)
+            for chunk_index in itertools.product(*[range(num_chunks) for num_chunks in chunk_grid_shape]):
+                chunk_mask_selection = tuple(
+                    slice(index * chunk_length, (index + 1) * chunk_length)
+                    for index, chunk_length in zip(chunk_index, self.chunk_shape[1:])
+                )
+                self._is_chunk_outside_mask[chunk_index] = not np.any(mask[chunk_mask_selection])
+
+        self._chunk_queue = deque()
+        self.num_chunks = 0
+        self.num_skipped_chunks = 0
+        self.written_bytes = 0
+        self.skipped_bytes = 0
+        self.write_time = 0.0
+        self._last_chunk_bytes = 0
+        self._last_chunk_time = None
+
+    def _get_default_chunk_shape(self, chunk_mb: float) -> tuple:
+        num_frames = self._maxshape[0]
+        image_shape = self._maxshape[1:]
+        spatial_chunk_shape = tuple(
+            min(chunk_length, axis_length) for chunk_length, axis_length in zip(self.spatial_chunk_shape, image_shape)
+        )
+
+        spatial_chunk_size_bytes = math.prod(spatial_chunk_shape) * self._dtype.itemsize
+        num_frames_per_chunk = int(chunk_mb * 1e6 / spatial_chunk_size_bytes)
+        # Smaller tiles would otherwise make much deeper chunks than the whole plane chunks of the parent class
+        plane_size_bytes = math.prod(image_shape[:2]) * self._dtype.itemsize
+        num_frames_per_chunk = min(num_frames_per_chunk, int(chunk_mb * 1e6 / plane_size_bytes))
+        chunk_shape = (max(min(num_frames_per_chunk, num_frames), 1),) + spatial_chunk_shape
+
+        return chunk_shape
+
+    def _is_fill_value(self, chunk_data: np.ndarray) -> bool:
+        if np.isnan(self.fill_value):
+            return bool(np.all(np.isnan(chunk_data)))
+
+        return not np.any(chunk_data != self.fill_value)
+
+    def _split_buffer(self, buffer_data_chunk: DataChunk):
+        buffer_selection = buffer_data_chunk.selection
+        chunk_starts = [
+            range(axis_selection.start, axis_selection.stop, chunk_length)
+            for axis_selection, chunk_length in zip(buffer_selection, self.chunk_shape)
+        ]
+        for chunk_start in itertools.product(*chunk_starts):
+            chunk_selection = tuple(
+                slice(start, min(start + chunk_length, axis_selection.stop))
+                for start, chunk_length, axis_selection in zip(chunk_start, self.chunk_shape, buffer_selection)
+            )
+            chunk_data = buffer_data_chunk.data[
+                tuple(
+                    slice(selection.start - axis_selection.start, selection.stop - axis_selection.start)
+                    for selection, axis_selection in zip(chunk_selection, buffer_selection)
+                )
+            ]
+
+            self.num_chunks += 1
+            chunk_index = tuple(start // chunk_length for start, chunk_length in zip(chunk_start, self.chunk_shape))
+            if self._is_chunk_outside_mask[chunk_index[1:]] and self._is_fill_value(chunk_data):
+                self.num_skipped_chunks += 1
+                self.skipped_bytes += chunk_data.nbytes
+                continue
+
+            self._chunk_queue.append(DataChunk(data=chunk_data, selection=chunk_selection))
+
+    def __next__(self) -> DataChunk:
+        # The time between returning a chunk and the next call is spent compressing and writing that chunk
+        if self._last_chunk_time is not None:
+            self.write_time += time.perf_counter() - self._last_chunk_time
+            self.written_bytes += self._last_chunk_bytes
+            self._last_chunk_time = None
+
+        while not self._chunk_queue:
+            try:
+                buffer_data_chunk = super().__next__()
+            except StopIteration:
+                if self.verbose:
+                    self.print_statistics()
+                raise
+            self._split_buffer(buffer_data_chunk)
+
+        data_chunk = self._chunk_queue.popleft()
+        self._last_chunk_bytes = data_chunk.data.nbytes
+        self._last_chunk_time = time.perf_counter()
+
+        return data_chunk
+
+    def get_statistics(self) -> dict:
+        """
+        The chunks and bytes that were not written and an estimate of the writing time saved from the writing
+        throughput of the chunks that were written.
+        """
+        write_seconds_per_byte = self.write_time / self.written_bytes if self.written_bytes else 0.0
+        statistics = dict(
+            num_chunks=self.num_chunks,
+            num_skipped_chunks=self.num_skipped_chunks,
+            written_bytes=self.written_bytes,
+            skipped_bytes=self.skipped_bytes,
+            write_time=self.write_time,
+            estimated_saved_time=self.skipped_bytes * write_seconds_per_byte,
+        )
+        return statistics
+
+    def print_statistics(self):
+        statistics = self.get_statistics()
+        print(
+            f"Skipped {statistics['num_skipped_chunks']} of {statistics['num_chunks']} chunks with only the fill value "
+            f"{self.fill_value}: {statistics['skipped_bytes'] / 1e9:.2f} GB not written, "
+            f"about {statistics['estimated_saved_time']:.1f} s saved "
+            f"({statistics['written_bytes'] / 1e9:.2f} GB written in {statistics['write_time']:.1f} s)"
+        )
+
+
+class PrefetchingImagingInterface(BaseImagingExtractorInterface):
+    """
+    Imaging interface that reads the next buffers of frames in the background while the current one is written
+    and that exposes the options of the data chunk iterator.
+    """
+
+    data_chunk_iterator = None  # The iterator of the last series added, for its prefetch statistics
+
+    def get_stub_imaging_extractor(self, stub_test: bool = False, stub_frames: int = 100):
+        imaging_extractor = self.imaging_extractor
+        if stub_test:
+            stub_frames = min([stub_frames, imaging_extractor.get_num_frames()])
+            imaging_extractor = imaging_extractor.frame_slice(start_frame=0, end_frame=stub_frames)
+
+        return imaging_extractor
+
+    def get_prefetch_statistics(self) -> Optional[Dict[str, float]]:
+        """
+        Get the wait times of the prefetching of the series once it has been written, None before it is added.
+
+        See `PrefetchingImagingExtractorDataChunkIterator.get_prefetch_statistics`.
+        """
+        if self.data_chunk_iterator is None:
+            return None
+        return self.data_chunk_iterator.get_prefetch_statistics()
+
+    def add_photon_series(
+        self,
+        nwbfile: NWBFile,
+        metadata: Optional[dict],
+        imaging_extractor,
+        data_chunk_iterator: ImagingExtractorDataChunkIterator,
+        photon_series_type: Literal["TwoPhotonSeries", "OnePhotonSeries"] = "TwoPhotonSeries",
+        photon_series_index: int = 0,
+        parent_container: Literal["acquisition", "processing/ophys"] = "acquisition",
+        data_io_kwargs: Optional[dict] = None,
+    ):
+        """
+        Add the photon series with the given data chunk iterator, as `add_imaging` of neuroconv does with its own.
+
+        Parameters
+        ----------
+        imaging_extractor : ImagingExtractor
+            The extractor that is written, used for the shape and the timing of the series.
+        data_chunk_iterator : ImagingExtractorDataChunkIterator
+            The iterator of the data of the series.
+        data_io_kwargs : dict, optional
+            Options of the `H5DataIO` of the data in addition to the compression, for example `fillvalue`.
+        """
+        from hdmf.backends.hdf5.h5_utils import H5DataIO
+        from neuroconv.tools.nwb_helpers import get_module
+        from neuroconv.tools.roiextractors import add_devices, add_imaging_plane
+        from neuroconv.tools.roiextractors.roiextractors import get_nwb_imaging_metadata
+        from neuroconv.utils import calculate_regular_series_rate
+        from pynwb.ophys import OnePhotonSeries, TwoPhotonSeries
+
+        metadata = metadata or self.get_metadata()
+        add_devices(nwbfile=nwbfile, metadata=metadata)
+        metadata = dict_deep_update(
+            get_nwb_imaging_metadata(imaging_extractor, photon_series_type=photon_series_type),
+            deepcopy(metadata),
+            append_list=False,
+        )
+
+        photon_series_kwargs = deepcopy(metadata["Ophys"][photon_series_type][photon_series_index])
+        imaging_plane_name = photon_series_kwargs["imaging_plane"]
+        add_imaging_plane(nwbfile=nwbfile, metadata=metadata, imaging_plane_name=imaging_plane_name)
+        photon_series_kwargs.update(
+            imaging_plane=nwbfile.get_imaging_plane(name=imaging_plane_name),
+            data=H5DataIO(data=data_chunk_iterator, compression=True, **(data_io_kwargs or dict())),
+            dimension=imaging_extractor.get_image_size(),
+        )
+
+        if imaging_extractor.has_time_vector():
+            timestamps = imaging_extractor.frame_to_time(np.arange(imaging_extractor.get_num_frames()))
+            estimated_rate = calculate_regular_series_rate(series=timestamps)
+            if estimated_rate:
+                photon_series_kwargs.update(starting_time=timestamps[0], rate=estimated_rate)
+            else:
+                photon_series_kwargs.update(timestamps=H5DataIO(data=timestamps, compression="gzip"), rate=None)
+        else:
+            photon_series_kwargs.update(rate=float(imaging_extractor.get_sampling_frequency()))
+
+        photon_series_class = dict(OnePhotonSeries=OnePhotonSeries, TwoPhotonSeries=TwoPhotonSeries)[photon_series_type]
+        photon_series = photon_series_class(**photon_series_kwargs)
+        if parent_container == "acquisition":
+            nwbfile.add_acquisition(photon_series)
+        else:
+            get_module(nwbfile, name="ophys").add(photon_series)
+
+    def add_to_nwbfile(
+        self,
+        nwbfile: NWBFile,
+        metadata: Optional[dict] = None,
+        photon_series_type: Literal["TwoPhotonSeries", "OnePhotonSeries"] = "TwoPhotonSeries",
+        photon_series_index: int = 0,
+        parent_container: Literal["acquisition", "processing/ophys"] = "acquisition",
+        stub_test: bool = False,
+        stub_frames: int = 100,
+        num_prefetch_blocks: int = 0,
+        iterator_options: Optional[dict] = None,
+    ):
+        """
+        Add the imaging data to the NWB file.
+
+        Parameters
+        ----------
+        num_prefetch_blocks : int, default: 0
+            The number of buffers of the data chunk iterator read ahead in a background thread while writing.
+            0 disables the prefetching.
+        iterator_options : dict, optional
+            Options of the `ImagingExtractorDataChunkIterator`, for example `buffer_gb`.
+
+        See `BaseImagingExtractorInterface.add_to_nwbfile` for the rest of the parameters.
+        """
+        imaging_extractor = self.get_stub_imaging_extractor(stub_test=stub_test, stub_frames=stub_frames)
+        self.data_chunk_iterator = PrefetchingImagingExtractorDataChunkIterator(
+            imaging_extractor=imaging_extractor,
+            num_buffers_ahead=num_prefetch_blocks,
+            verbose=self.verbose,
+            **(iterator_options or dict()),
+        )
+        self.add_photon_series(
+            nwbfile=nwbfile,
+            metadata=metadata,
+            imaging_extractor=imaging_extractor,
+            data_chunk_iterator=self.data_chunk_iterator,
+            photon_series_type=photon_series_type,
+            photon_series_index=photon_series_index,
+            parent_container=parent_container,
+        )
+
+
+class NiftiImagingInterface(PrefetchingImagingInterface):
     Extractor = NIfTIImagingExtractor
 
     def __init__(
@@ -27,6 +545,107 @@ class NiftiImagingInterface(BaseImagingExtractorInterface):
             verbose=verbose,
         )
 
+    def get_mask(
+        self, fill_value: float = 0.0, num_volumes: int = 10, mask_file_path: Optional[FilePathType] = None
+    ) -> np.ndarray:
+        """
+        The voxels that can have values different from the fill value, in the NWB convention (width, height, depth).
+
+        Parameters
+        ----------
+        fill_value : float, default: 0.0
+        num_volumes : int, default: 10
+            The number of volumes from the start of the data used to compute the mask.
+        mask_file_path : FilePathType, optional
+            A NIfTI file with a mask or atlas in the same space as the data, where the voxels outside of the brain
+            are zero. When given it is used instead of the first volumes.
+        """
+        if mask_file_path is not None:
+            import nibabel
+
+            mask_image = nibabel.load(mask_file_path)
+            mask = np.asarray(mask_image.dataobj)
+            mask = mask.reshape(mask.shape[:3]) != 0
+        else:
+            num_volumes = min(num_volumes, self.imaging_extractor.get_num_frames())
+            video = self.imaging_extractor.get_video(start_frame=0, end_frame=num_volumes)
+            is_fill_value = np.isnan(video) if np.isnan(fill_value) else video == fill_value
+            # From the roiextractors convention (t, rows, columns, depth) to the NWB one (width, height, depth)
+            mask = np.any(~is_fill_value, axis=0).transpose(1, 0, 2)
+
+        return mask
+
+    def add_to_nwbfile(
+        self,
+        nwbfile: NWBFile,
+        metadata: Optional[dict] = None,
+        photon_series_type: Literal["TwoPhotonSeries", "OnePhotonSeries"] = "TwoPhotonSeries",
+        photon_series_index: int = 0,
+        parent_container: Literal["acquisition", "processing/ophys"] = "acquisition",
+        stub_test: bool = False,
+        stub_frames: int = 100,
+        num_prefetch_blocks: int = 0,
+        iterator_options: Optional[dict] = None,
+        skip_fill_chunks: bool = True,
+        fill_value: float = 0.0,
+        num_mask_volumes: int = 10,
+        mask_file_path: Optional[FilePathType] = None,
+    ):
+        """
+        Add the processed imaging data to the NWB file.
+
+        The processed volumes are masked to the brain, so when `skip_fill_chunks` is True the chunks where all the
+        voxels are the fill value are not written. The dataset is created with that fill value so they read the same.
+
+        Parameters
+        ----------
+        skip_fill_chunks : bool, default: True
+            Do not write the chunks where all the values are `fill_value`.
+        fill_value : float, default: 0.0
+            The fill value of the dataset, the value of the voxels outside of the mask.
+        num_mask_volumes : int, default: 10
+            The number of volumes from the start of the data used to compute the mask, see `get_mask`.
+        mask_file_path : FilePathType, optional
+            A NIfTI file with the mask or atlas used instead of the first volumes, see `get_mask`.
+
+        See `PrefetchingImagingInterface.add_to_nwbfile` for the rest of the parameters.
+        """
+        if not skip_fill_chunks:
+            super().add_to_nwbfile(
+                nwbfile=nwbfile,
+                metadata=metadata,
+                photon_series_type=photon_series_type,
+                photon_series_index=photon_series_index,
+                parent_container=parent_container,
+                stub_test=stub_test,
+                stub_frames=stub_frames,
+                num_prefetch_blocks=num_prefetch_blocks,
+                iterator_options=iterator_options,
+            )
+            return
+
+        imaging_extractor = self.get_stub_imaging_extractor(stub_test=stub_test, stub_frames=stub_frames)
+        mask = self.get_mask(fill_value=fill_value, num_volumes=num_mask_volumes, mask_file_path=mask_file_path)
+        self.data_chunk_iterator = FillValueSkippingDataChunkIterator(
+            imaging_extractor=imaging_extractor,
+            mask=mask,
+            fill_value=fill_value,
+            num_buffers_ahead=num_prefetch_blocks,
+            verbose=self.verbose,
+            **(iterator_options or dict()),
+        )
+        # The dataset is created with the fill value so that the chunks that are not written read as it
+        self.add_photon_series(
+            nwbfile=nwbfile,
+            metadata=metadata,
+            imaging_extractor=imaging_extractor,
+            data_chunk_iterator=self.data_chunk_iterator,
+            photon_series_type=photon_series_type,
+            photon_series_index=photon_series_index,
+            parent_container=parent_container,
+            data_io_kwargs=dict(fillvalue=fill_value),
+        )
+
     def get_metadata(self):
         metadata = super().get_metadata()
 
@@ -88,7 +707,7 @@ class NiftiImagingInterface(BaseImagingExtractorInterface):
         return metadata
 
 
-class BrezovecImagingInterface(BaseImagingExtractorInterface):
+class BrezovecImagingInterface(PrefetchingImagingInterface):
     """
     Data Interface for writing imaging data for the Clandinin lab to NWB file using BrezovecMultiPlaneImagingExtractor.
     """
@@ -118,8 +737,31 @@ class BrezovecImagingInterface(BaseImagingExtractorInterface):
 
     def get_metadata(self) -> DeepDict:
         metadata = super().get_metadata()
-        xml_metadata = self.imaging_extractor.xml_metadata
+        metadata = self.update_imaging_metadata(
+            metadata=metadata,
+            xml_metadata=self.imaging_extractor.xml_metadata,
+            channel=self.channel,
+            imaging_purpose=self.imaging_purpose,
+            sampling_frequency=self.imaging_extractor.get_sampling_frequency(),
+            image_size=self.imaging_extractor.get_image_size(),
+        )
+
+        return metadata
 
+    @staticmethod
+    def update_imaging_metadata(
+        metadata: dict,
+        xml_metadata: dict,
+        channel: Literal["Red", "Green"],
+        imaging_purpose: Literal["Functional", "Anatomical"],
+        sampling_frequency: float,
+        image_size: tuple,
+    ) -> dict:
+        """
+        Update the first Device, ImagingPlane and TwoPhotonSeries of the metadata from the Bruker XML metadata.
+
+        This does not need the extractor so it can also be used while the session is being acquired.
+        """
         indicators = dict(Red="tdTomato", Green="GCaMP6f")
 
         # Configure metadata according to the channel (Green/Red) and imaging_purpose (Functional/Anatomical)
@@ -134,7 +776,7 @@ class BrezovecImagingInterface(BaseImagingExtractorInterface):
                 "emission_lambda": 581.0,
                 "description": "Red channel of the microscope, 550/50 nm filter.",
             },
-        }[self.channel]
+        }[channel]
 
         optical_channel_metadata = channel_metadata
 
@@ -144,8 +786,8 @@ class BrezovecImagingInterface(BaseImagingExtractorInterface):
             name=device_name, description=f"Bruker Ultima IV, Version {version}", manufacturer="Bruker"
         )
 
-        indicator = indicators[self.channel]
-        imaging_plane_name = f"ImagingPlane{indicator}{self.imaging_purpose}"
+        indicator = indicators[channel]
+        imaging_plane_name = f"ImagingPlane{indicator}{imaging_purpose}"
         imaging_plane_metadata = metadata["Ophys"]["ImagingPlane"][0]
         imaging_plane_metadata.update(
             name=imaging_plane_name,
@@ -153,17 +795,17 @@ class BrezovecImagingInterface(BaseImagingExtractorInterface):
             device=device_name,
             excitation_lambda=920.0,  #   Chameleon Vision II femtosecond laser (Coherent) at 920 nm.
             indicator=indicator,
-            imaging_rate=self.imaging_extractor.get_sampling_frequency(),
+            imaging_rate=sampling_frequency,
             location="whole brain",
         )
 
         two_photon_series_metadata = metadata["Ophys"]["TwoPhotonSeries"][0]
         two_photon_series_metadata.update(
-            name=f"TwoPhotonSeries{self.imaging_purpose}{self.channel}",
+            name=f"TwoPhotonSeries{imaging_purpose}{channel}",
             imaging_plane=imaging_plane_name,
             scan_line_rate=1 / float(xml_metadata["scanLinePeriod"]),
-            rate=self.imaging_extractor.get_sampling_frequency(),
-            description=f"{self.imaging_purpose} imaging data ({indicator})",
+            rate=sampling_frequency,
+            description=f"{imaging_purpose} imaging data ({indicator})",
             unit="n.a.",
         )
 
@@ -176,7 +818,7 @@ class BrezovecImagingInterface(BaseImagingExtractorInterface):
 
             imaging_plane_metadata.update(grid_spacing=grid_spacing, grid_spacing_unit="meters")
 
-            image_size_in_pixels = self.imaging_extractor.get_image_size()
+            image_size_in_pixels = image_size
 
             field_of_view = [
                 pixel_size_in_meters_y * image_size_in_pixels[1],
@@ -207,36 +849,13 @@ class BrezovecImagingInterface(BaseImagingExtractorInterface):
 
     @staticmethod
     def read_session_start_time_from_file(xml_file_path):
-        from xml.etree import ElementTree
-        from dateutil import parser
-
-        date = None
-        first_timestamp = None
-
-        for event, elem in ElementTree.iterparse(xml_file_path, events=("start", "end")):
-            # Extract the date from PVScan
-            if date is None and elem.tag == "PVScan" and event == "end":
-                date_string = elem.attrib.get("date")
-                date = datetime.strptime(date_string, "%m/%d/%Y %I:%M:%S %p")
-                elem.clear()
-
-            # Extract the time from Sequence
-            if first_timestamp is None and elem.tag == "Sequence" and event == "end":
-                sequence_time = elem.get("time")
-                first_timestamp = parser.parse(sequence_time)
-                elem.clear()
-
-            if date is not None and first_timestamp is not None:
-                break
-
-        combined_datetime = datetime(
-            date.year,
-            date.month,
-            date.day,
-            first_timestamp.hour,
-            first_timestamp.minute,
-            first_timestamp.second,
-            first_timestamp.microsecond,
-        )
-
-        return combined_datetime
+        return read_session_start_time_from_file(xml_file_path=xml_file_path)
+
+
+class BrezovecTiffImagingInterface(BrezovecImagingInterface):
+    """
+    Data Interface for writing imaging data for the Clandinin lab to NWB file directly from the Bruker TIFF files
+    using BrezovecMultiPlaneTiffImagingExtractor, without the intermediate NIfTI files.
+    """
+
+    Extractor = BrezovecMultiPlaneTiffImagingExtractor
@@ -13,7 +13,7 @@ from neuroconv.datainterfaces import (
     FicTracDataInterface,
     VideoInterface,
 )
-from .brezovecimaginginterface import BrezovecImagingInterface, NiftiImagingInterface
+from .brezovecimaginginterface import BrezovecImagingInterface, BrezovecTiffImagingInterface, NiftiImagingInterface
 
 
 class BrezovecNWBConverter(NWBConverter):
@@ -98,3 +98,15 @@ class BrezovecNWBConverter(NWBConverter):
         camera_device = Device(name, description=description, manufacturer=manufacturer)
 
         nwbfile.add_device(camera_device)
+
+
+class BrezovecTiffNWBConverter(BrezovecNWBConverter):
+    """Conversion class for the brezovec conversion project that reads the raw imaging from the Bruker TIFF files."""
+
+    data_interface_classes = dict(
+        BrezovecNWBConverter.data_interface_classes,
+        ImagingFunctionalGreen=BrezovecTiffImagingInterface,
+        ImagingFunctionalRed=BrezovecTiffImagingInterface,
+        ImagingAnatomicalGreen=BrezovecTiffImagingInterface,
+        ImagingAnatomicalRed=BrezovecTiffImagingInterface,
+    )
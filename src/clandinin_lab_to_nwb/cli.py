@@ -0,0 +1,19 @@
+"""Entry point of the `clandinin-to-nwb` command."""
+
+import argparse
+from typing import List, Optional
+
+from clandinin_lab_to_nwb.brezovec.brezovec_cli import add_brezovec_parser
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(prog="clandinin-to-nwb", description="Convert Clandinin lab data to NWB.")
+    subparsers = parser.add_subparsers(dest="conversion", required=True)
+    add_brezovec_parser(subparsers)
+
+    args = parser.parse_args(argv)
+    args.function(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Small Bruker series written like the microscope does, shared by the tests of the TIFF extractors."""
+
+from pathlib import Path
+
+import numpy as np
+import tifffile
+
+NUM_VOLUMES = 6
+NUM_ROWS, NUM_COLUMNS, NUM_PLANES = 8, 16, 4
+VOLUME_PERIOD = 0.5
+CHANNELS = ((1, "Red"), (2, "Green"))
+
+
+def write_bruker_series(folder_path: Path, num_planes: int = NUM_PLANES, write_nifti: bool = False) -> dict:
+    """
+    Write a small series with one TIFF file per plane and channel, as the Bruker system does.
+
+    A series with a single plane is written as single plane imaging (zDevice 0) with all the frames in one Sequence
+    element. With `write_nifti` the NIfTI file of every channel is also written, as the lab converts them.
+
+    Returns
+    -------
+    dict
+        The video written for every channel name, in the roiextractors convention (t, rows, columns, planes).
+    """
+    folder_path.mkdir(parents=True)
+    rng = np.random.default_rng(0)
+    videos = {channel_name: [] for _, channel_name in CHANNELS}
+    frame_elements = []
+    for volume_index in range(NUM_VOLUMES):
+        volume_frame_elements = []
+        for plane_index in range(num_planes):
+            file_elements = []
+            file_index = plane_index + 1 if num_planes > 1 else volume_index + 1
+            for channel, channel_name in CHANNELS:
+                file_name = f"{folder_path.name}_Cycle{volume_index + 1:05d}_Ch{channel}_{file_index:06d}.ome.tif"
+                page = rng.integers(0, 4000, size=(NUM_ROWS, NUM_COLUMNS), dtype=np.uint16)
+                tifffile.imwrite(folder_path / file_name, page)
+                videos[channel_name].append(page)
+                file_elements.append(
+                    f'<File channel="{channel}" channelName="{channel_name}" page="1" filename="{file_name}" />'
+                )
+            relative_time = volume_index * VOLUME_PERIOD + plane_index * VOLUME_PERIOD / num_planes
+            volume_frame_elements.append(
+                f'<Frame relativeTime="{relative_time:.6f}" absoluteTime="{relative_time + 1:.6f}" '
+                f'index="{file_index}">{"".join(file_elements)}</Frame>'
+            )
+        frame_elements.append("".join(volume_frame_elements))
+
+    if num_planes > 1:
+        sequences = [
+            f'<Sequence type="TSeries ZSeries Element" cycle="{volume_index + 1}" '
+            f'time="10:00:05.1234567-07:00">{volume_frame_elements}</Sequence>'
+            for volume_index, volume_frame_elements in enumerate(frame_elements)
+        ]
+    else:
+        sequences = [
+            f'<Sequence type="TSeries Timed Element" cycle="1" '
+            f'time="10:00:05.1234567-07:00">{"".join(frame_elements)}</Sequence>'
+        ]
+
+    xml_text = f"""<?xml version="1.0" encoding="utf-8"?>
+<PVScan version="5.5.64.100" date="6/20/2020 10:00:00 AM" notes="">
+<PVStateShard>
+<PVStateValue key="zDevice" value="{int(num_planes > 1)}" />
+<PVStateValue key="scanLinePeriod" value="0.000063" />
+<PVStateValue key="micronsPerPixel">
+<IndexedValue index="XAxis" value="2.6" />
+<IndexedValue index="YAxis" value="2.6" />
+<IndexedValue index="ZAxis" value="5" />
+</PVStateValue>
+</PVStateShard>
+{"".join(sequences)}
+</PVScan>"""
+    (folder_path / f"{folder_path.name}.xml").write_text(xml_text)
+
+    videos = {
+        channel_name: np.stack(pages).reshape(NUM_VOLUMES, num_planes, NUM_ROWS, NUM_COLUMNS).transpose(0, 2, 3, 1)
+        for channel_name, pages in videos.items()
+    }
+    if write_nifti:
+        import nibabel
+
+        for channel, channel_name in CHANNELS:
+            # The NIfTI files are in (x - columns, y - rows, z, t) order
+            nifti_image = nibabel.Nifti1Image(videos[channel_name].transpose(2, 1, 3, 0), affine=np.eye(4))
+            nibabel.save(nifti_image, folder_path / f"{folder_path.name}_channel_{channel}.nii")
+
+    return videos
@@ -0,0 +1,76 @@
+import shutil
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+
+def get_script_path() -> str:
+    script_path = Path(sys.executable).parent / "clandinin-to-nwb"
+    if script_path.exists():
+        return str(script_path)
+    script_path = shutil.which("clandinin-to-nwb")
+    if script_path is None:
+        pytest.skip("The package is not installed with its console script.")
+    return script_path
+
+
+@pytest.fixture
+def data_dir_path(tmp_path):
+    for subject_id in ("fly1", "fly2"):
+        (tmp_path / "imports" / "20200620" / subject_id).mkdir(parents=True)
+    (tmp_path / "imports" / "20200620" / "notes").mkdir()
+    return tmp_path
+
+
+def test_list_is_fast(data_dir_path):
+    start_time = time.perf_counter()
+    result = subprocess.run(
+        [get_script_path(), "brezovec", "list", str(data_dir_path)], capture_output=True, text=True, check=True
+    )
+    elapsed_seconds = time.perf_counter() - start_time
+
+    assert result.stdout.splitlines() == ["20200620 fly1", "20200620 fly2"]
+    assert elapsed_seconds < 0.3
+
+
+def test_import_does_not_load_conversion_stack():
+    # In a new interpreter because other tests might have imported the conversion stack already
+    code = (
+        "import sys\n"
+        "import clandinin_lab_to_nwb.brezovec, clandinin_lab_to_nwb.cli\n"
+        "print(' '.join(name for name in ('neuroconv', 'pynwb', 'nibabel') if name in sys.modules))\n"
+    )
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+
+    assert result.stdout.strip() == ""
+
+
+def test_missing_imports_folder_is_reported(tmp_path):
+    result = subprocess.run([get_script_path(), "brezovec", "list", str(tmp_path)], capture_output=True, text=True)
+
+    assert result.returncode == 2
+    assert "Traceback" not in result.stderr
+    assert "imports is missing" in result.stderr
+
+
+def test_single_session_needs_subject_and_date(data_dir_path, tmp_path):
+    result = subprocess.run(
+        [
+            get_script_path(),
+            "brezovec",
+            "convert",
+            str(data_dir_path),
+            str(tmp_path / "output"),
+            "--subject-id",
+            "fly1",
+        ],
+        capture_output=True,
+        text=True,
+    )
+
+    assert result.returncode == 2
+    assert "Traceback" not in result.stderr
+    assert "Both --subject-id and --date-string are needed" in result.stderr
@@ -0,0 +1,77 @@
+import threading
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+tifffile = pytest.importorskip("tifffile")
+h5py = pytest.importorskip("h5py")
+
+from bruker_series import CHANNELS, NUM_VOLUMES, write_bruker_series  # noqa: E402
+from clandinin_lab_to_nwb.brezovec.brezovec_follow_session import (  # noqa: E402
+    follow_session_to_nwb,
+    simulate_acquisition,
+)
+from clandinin_lab_to_nwb.brezovec.brezovecimagingextractor import (  # noqa: E402
+    BrezovecMultiPlaneTiffImagingExtractor,
+)
+
+
+def follow_simulated_acquisition(tmp_path: Path, num_volumes=None, idle_timeout: float = 30.0) -> dict:
+    source_folder_path = tmp_path / "source" / "TSeries-001"
+    write_bruker_series(source_folder_path)
+    folder_path = tmp_path / "acquisition" / "TSeries-001"
+    nwbfile_path = tmp_path / "follow.nwb"
+
+    simulation_thread = threading.Thread(
+        target=simulate_acquisition,
+        kwargs=dict(
+            source_folder_path=source_folder_path,
+            folder_path=folder_path,
+            volume_interval=0.05,
+            xml_write_size=256,
+            num_volumes=num_volumes,
+        ),
+    )
+    simulation_thread.start()
+    try:
+        result = follow_session_to_nwb(
+            folder_path=folder_path,
+            nwbfile_path=nwbfile_path,
+            subject_id="fly_094",
+            poll_interval=0.02,
+            idle_timeout=idle_timeout,
+        )
+    finally:
+        simulation_thread.join()
+
+    return dict(result, source_folder_path=source_folder_path)
+
+
+def assert_matches_extractor(nwbfile_path: Path, source_folder_path: Path, num_volumes: int):
+    with h5py.File(nwbfile_path, "r") as file:
+        for _, channel_name in CHANNELS:
+            extractor = BrezovecMultiPlaneTiffImagingExtractor(folder_path=source_folder_path, stream_name=channel_name)
+            two_photon_series = file["acquisition"][f"TwoPhotonSeriesFunctional{channel_name}"]
+
+            # From the roiextractors convention (t, rows, columns, depth) to the NWB one (t, width, height, depth)
+            expected_data = extractor.get_video(start_frame=0, end_frame=num_volumes).transpose(0, 2, 1, 3)
+            np.testing.assert_array_equal(two_photon_series["data"][:], expected_data)
+            np.testing.assert_allclose(two_photon_series["timestamps"][:], extractor.get_timestamps()[:num_volumes])
+
+
+def test_follow_complete_acquisition(tmp_path):
+    result = follow_simulated_acquisition(tmp_path)
+
+    assert result["is_complete"]
+    assert result["num_volumes"] == NUM_VOLUMES
+    assert_matches_extractor(result["nwbfile_path"], result["source_folder_path"], num_volumes=NUM_VOLUMES)
+
+
+def test_follow_aborted_acquisition(tmp_path):
+    num_acquired_volumes = 4
+    result = follow_simulated_acquisition(tmp_path, num_volumes=num_acquired_volumes, idle_timeout=1.0)
+
+    assert not result["is_complete"]
+    assert result["num_volumes"] == num_acquired_volumes
+    assert_matches_extractor(result["nwbfile_path"], result["source_folder_path"], num_volumes=num_acquired_volumes)
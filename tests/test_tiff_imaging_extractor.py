@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("tifffile")
+pytest.importorskip("nibabel")
+
+from bruker_series import CHANNELS, NUM_COLUMNS, NUM_ROWS, NUM_VOLUMES, VOLUME_PERIOD, write_bruker_series  # noqa: E402
+from clandinin_lab_to_nwb.brezovec.brezovecimagingextractor import (  # noqa: E402
+    BrezovecMultiPlaneImagingExtractor,
+    BrezovecMultiPlaneTiffImagingExtractor,
+    BrezovecSinglePlaneImagingExtractor,
+)
+
+FRAME_RANGES = [(None, None), (0, NUM_VOLUMES), (2, 5), (3, 3)]
+
+
+@pytest.mark.parametrize("channel_name", [channel_name for _, channel_name in CHANNELS])
+def test_tiff_extractor_matches_nifti_extractor(tmp_path, channel_name):
+    folder_path = tmp_path / "TSeries-001"
+    write_bruker_series(folder_path, write_nifti=True)
+
+    tiff_extractor = BrezovecMultiPlaneTiffImagingExtractor(folder_path=folder_path, stream_name=channel_name)
+    nifti_extractor = BrezovecMultiPlaneImagingExtractor(folder_path=folder_path, stream_name=channel_name)
+
+    for start_frame, end_frame in FRAME_RANGES:
+        tiff_video = tiff_extractor.get_video(start_frame=start_frame, end_frame=end_frame)
+        nifti_video = nifti_extractor.get_video(start_frame=start_frame, end_frame=end_frame)
+        assert tiff_video.dtype == nifti_video.dtype
+        np.testing.assert_array_equal(tiff_video, nifti_video)
+    np.testing.assert_array_equal(tiff_extractor.get_timestamps(), nifti_extractor.get_timestamps())
+    assert tiff_extractor.get_num_frames() == nifti_extractor.get_num_frames() == NUM_VOLUMES
+    assert tiff_extractor.get_image_size() == nifti_extractor.get_image_size()
+    assert tiff_extractor.get_dtype() == nifti_extractor.get_dtype()
+    assert tiff_extractor.get_sampling_frequency() == nifti_extractor.get_sampling_frequency()
+    assert tiff_extractor.xml_metadata == nifti_extractor.xml_metadata
+
+
+def test_single_plane_extractor(tmp_path):
+    folder_path = tmp_path / "TSeries-001"
+    videos = write_bruker_series(folder_path, num_planes=1)
+
+    for _, channel_name in CHANNELS:
+        extractor = BrezovecSinglePlaneImagingExtractor(folder_path=folder_path, stream_name=channel_name)
+        expected_video = videos[channel_name][..., 0]
+
+        np.testing.assert_array_equal(extractor.get_video(), expected_video)
+        np.testing.assert_array_equal(extractor.get_video(start_frame=2, end_frame=5), expected_video[2:5])
+        np.testing.assert_array_equal(extractor.get_video(start_frame=3, end_frame=3), expected_video[3])
+        np.testing.assert_allclose(extractor.get_timestamps(), np.arange(NUM_VOLUMES) * VOLUME_PERIOD)
+        assert extractor.get_num_frames() == NUM_VOLUMES
+        assert extractor.get_image_size() == (NUM_ROWS, NUM_COLUMNS)
+        assert extractor.get_dtype() == np.dtype("uint16")
+
+    with pytest.raises(AssertionError, match="BrezovecSinglePlaneImagingExtractor"):
+        BrezovecMultiPlaneTiffImagingExtractor(folder_path=folder_path, stream_name="Green")
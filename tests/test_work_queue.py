@@ -0,0 +1,191 @@
+import multiprocessing
+import os
+import time
+from pathlib import Path
+
+from clandinin_lab_to_nwb.brezovec.brezovec_work_queue import SessionWorkQueue, run_worker
+
+HEARTBEAT_INTERVAL = 0.2
+HEARTBEAT_TIMEOUT = 1.0
+
+
+def convert_session(date_string: str, subject_id: str, output_dir_path: Path, log_dir_path: Path):
+    """Record every conversion in the log and write an output file like `session_to_nwb`."""
+    (Path(log_dir_path) / f"{date_string}_{subject_id}@{os.getpid()}").touch()
+    time.sleep(0.02)
+    output_dir_path.mkdir(parents=True, exist_ok=True)
+    (output_dir_path / f"{subject_id}.nwb").write_text(str(os.getpid()))
+
+
+def run_test_worker(queue_dir_path: Path, output_dir_path: Path, log_dir_path: Path):
+    return run_worker(
+        queue_dir_path=queue_dir_path,
+        convert_session=convert_session,
+        output_dir_path=output_dir_path,
+        heartbeat_interval=HEARTBEAT_INTERVAL,
+        heartbeat_timeout=HEARTBEAT_TIMEOUT,
+        poll_interval=0.1,
+        conversion_kwargs=dict(log_dir_path=log_dir_path),
+    )
+
+
+def get_sessions(num_sessions: int):
+    return [dict(date_string="20200620", subject_id=f"fly{index:03d}") for index in range(num_sessions)]
+
+
+def make_dirs(tmp_path: Path):
+    dir_paths = [tmp_path / "queue", tmp_path / "output", tmp_path / "log"]
+    for dir_path in dir_paths:
+        dir_path.mkdir()
+    return dir_paths
+
+
+def test_sessions_are_converted_once_by_concurrent_workers(tmp_path):
+    queue_dir_path, output_dir_path, log_dir_path = make_dirs(tmp_path)
+    sessions = get_sessions(num_sessions=40)
+    work_queue = SessionWorkQueue(
+        queue_dir_path, heartbeat_interval=HEARTBEAT_INTERVAL, heartbeat_timeout=HEARTBEAT_TIMEOUT
+    )
+    assert work_queue.add_sessions(sessions) == 40
+    assert work_queue.add_sessions(sessions) == 0
+
+    num_workers = 6
+    with multiprocessing.Pool(processes=num_workers) as pool:
+        results = [
+            pool.apply_async(run_test_worker, (queue_dir_path, output_dir_path, log_dir_path))
+            for _ in range(num_workers)
+        ]
+        converted_session_keys = [key for result in results for key in result.get(timeout=60)]
+
+    session_keys = sorted(work_queue.get_session_key(session) for session in sessions)
+    assert sorted(converted_session_keys) == session_keys
+    logged_session_keys = [path.name.split("@")[0] for path in log_dir_path.iterdir()]
+    assert sorted(logged_session_keys) == session_keys
+    assert sorted(path.name for path in output_dir_path.iterdir()) == [f"{s['subject_id']}.nwb" for s in sessions]
+    assert work_queue.get_status() == dict(pending=0, claimed=0, done=40, failed=0)
+
+
+def test_stale_claim_is_reclaimed(tmp_path):
+    queue_dir_path, output_dir_path, log_dir_path = make_dirs(tmp_path)
+    sessions = get_sessions(num_sessions=3)
+    work_queue = SessionWorkQueue(
+        queue_dir_path, heartbeat_interval=HEARTBEAT_INTERVAL, heartbeat_timeout=HEARTBEAT_TIMEOUT
+    )
+    work_queue.add_sessions(sessions)
+
+    # A worker that died after claiming a session and leaving part of its output behind
+    claim_file_path = work_queue.claim(worker_id="dead-worker")
+    stale_time = time.time() - 10 * HEARTBEAT_TIMEOUT
+    os.utime(claim_file_path, (stale_time, stale_time))
+    (output_dir_path / f".{claim_file_path.name}").mkdir()
+    (output_dir_path / f".{claim_file_path.name}" / "fly000.nwb").write_text("partial")
+
+    converted_session_keys = run_test_worker(queue_dir_path, output_dir_path, log_dir_path)
+
+    assert sorted(converted_session_keys) == sorted(work_queue.get_session_key(session) for session in sessions)
+    assert work_queue.get_status() == dict(pending=0, claimed=0, done=3, failed=0)
+    assert (output_dir_path / "fly000.nwb").read_text() == str(os.getpid())
+
+
+def test_output_of_lost_claim_is_discarded(tmp_path):
+    queue_dir_path, output_dir_path, log_dir_path = make_dirs(tmp_path)
+    work_queue = SessionWorkQueue(
+        queue_dir_path, heartbeat_interval=HEARTBEAT_INTERVAL, heartbeat_timeout=HEARTBEAT_TIMEOUT
+    )
+    work_queue.add_sessions(get_sessions(num_sessions=1))
+
+    num_conversions = []
+
+    def convert_and_lose_first_claim(date_string: str, subject_id: str, output_dir_path: Path):
+        num_conversions.append(1)
+        output_dir_path.mkdir(parents=True)
+        (output_dir_path / f"{subject_id}.nwb").write_text(f"conversion {len(num_conversions)}")
+        if len(num_conversions) == 1:
+            # Another worker takes the session over while this one is still converting it
+            (claim_file_path,) = (queue_dir_path / "claimed").iterdir()
+            os.rename(claim_file_path, queue_dir_path / "pending" / claim_file_path.name.split("@")[0])
+
+    converted_session_keys = run_worker(
+        queue_dir_path=queue_dir_path,
+        convert_session=convert_and_lose_first_claim,
+        output_dir_path=output_dir_path,
+        heartbeat_interval=HEARTBEAT_INTERVAL,
+        heartbeat_timeout=HEARTBEAT_TIMEOUT,
+        poll_interval=0.1,
+    )
+
+    assert converted_session_keys == ["20200620_fly000"]
+    assert len(num_conversions) == 2
+    assert [path.name for path in output_dir_path.iterdir()] == ["fly000.nwb"]
+    assert (output_dir_path / "fly000.nwb").read_text() == "conversion 2"
+
+
+def test_longest_planned_sessions_are_claimed_first(tmp_path):
+    queue_dir_path, output_dir_path, log_dir_path = make_dirs(tmp_path)
+    work_queue = SessionWorkQueue(
+        queue_dir_path, heartbeat_interval=HEARTBEAT_INTERVAL, heartbeat_timeout=HEARTBEAT_TIMEOUT
+    )
+    runtimes = [5.0, 30.0, 10.0]
+    sessions = [
+        dict(session, runtime_seconds=runtime_seconds, recommended_num_workers=2)
+        for session, runtime_seconds in zip(get_sessions(num_sessions=3), runtimes)
+    ]
+    work_queue.add_sessions(sessions)
+    assert work_queue.get_unregistered_sessions(get_sessions(num_sessions=4)) == get_sessions(num_sessions=4)[3:]
+    assert work_queue.read_sessions() == sessions
+
+    # The plan estimates are not arguments of the conversion
+    converted_session_keys = run_test_worker(queue_dir_path, output_dir_path, log_dir_path)
+
+    assert converted_session_keys == ["20200620_fly001", "20200620_fly002", "20200620_fly000"]
+
+
+def test_output_of_completed_claim_of_dead_worker_is_moved(tmp_path):
+    queue_dir_path, output_dir_path, log_dir_path = make_dirs(tmp_path)
+    work_queue = SessionWorkQueue(
+        queue_dir_path, heartbeat_interval=HEARTBEAT_INTERVAL, heartbeat_timeout=HEARTBEAT_TIMEOUT
+    )
+    work_queue.add_sessions(get_sessions(num_sessions=2))
+
+    # A worker that died after marking its session as done but before moving the output
+    claim_file_path = work_queue.claim(worker_id="dead-worker")
+    convert_session("20200620", "fly000", output_dir_path / f".{claim_file_path.name}", log_dir_path)
+    assert work_queue.complete(claim_file_path)
+    # And a worker that lost its claim of the same session and died before deleting its output
+    (output_dir_path / ".20200620_fly000@lost-worker").mkdir()
+    (output_dir_path / ".20200620_fly000@lost-worker" / "fly000.nwb").write_text("partial")
+
+    converted_session_keys = run_test_worker(queue_dir_path, output_dir_path, log_dir_path)
+
+    assert converted_session_keys == ["20200620_fly001"]
+    assert work_queue.get_status() == dict(pending=0, claimed=0, done=2, failed=0)
+    assert (output_dir_path / "fly000.nwb").read_text() == str(os.getpid())
+    assert not (output_dir_path / f".{claim_file_path.name}").exists()
+
+
+def test_session_that_can_not_be_planned_is_marked_as_failed(tmp_path):
+    from clandinin_lab_to_nwb.brezovec.brezovec_convert_all_sessions import convert_all_sessions
+
+    queue_dir_path, output_dir_path, _ = make_dirs(tmp_path)
+    # Sessions without imaging folders fail both planning and conversion
+    data_dir_path = tmp_path / "data"
+    for subject_id in ("fly1", "fly2"):
+        (data_dir_path / "imports" / "20200620" / subject_id).mkdir(parents=True)
+
+    convert_all_sessions(
+        data_dir_path=data_dir_path,
+        output_dir_path=output_dir_path,
+        queue_dir_path=queue_dir_path,
+        heartbeat_interval=HEARTBEAT_INTERVAL,
+        heartbeat_timeout=HEARTBEAT_TIMEOUT,
+    )
+
+    work_queue = SessionWorkQueue(
+        queue_dir_path, heartbeat_interval=HEARTBEAT_INTERVAL, heartbeat_timeout=HEARTBEAT_TIMEOUT
+    )
+    assert work_queue.get_status() == dict(pending=0, claimed=0, done=0, failed=2)
+    assert work_queue.read_sessions() == [
+        dict(date_string="20200620", subject_id="fly1"),
+        dict(date_string="20200620", subject_id="fly2"),
+    ]
+    assert "FileNotFoundError" in (queue_dir_path / "failed" / "20200620_fly1.log").read_text()